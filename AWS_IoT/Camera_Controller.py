@@ -8,6 +8,7 @@
 import paho.mqtt.client as mqtt
 import ssl, time, sys, json
 import picamera
+from shadow_publisher import ShadowPublisher
 import os
 from time import sleep
 
@@ -46,6 +47,9 @@ SHADOW_STATE_DOC_Camera_OFF = """{"state" : {"reported" : {"Camera" : "OFF"}}}""
 mqttc = mqtt.Client("Bing_2")
 snapshot = 'my_image.jpg'
 
+# Merges the reported state changes of a burst into one shadow update
+publisher = ShadowPublisher(mqttc, SHADOW_UPDATE_TOPIC)
+
 # Master Camera Control Function
 def Camera_Status_Change(Shadow_State_Doc, Type):
 	# Parse Camera Status from Shadow
@@ -73,14 +77,14 @@ def Camera_Status_Change(Shadow_State_Doc, Type):
 		camera.close()
 		# Report Camera ON Status back to Shadow
 		print("Camera Turned ON. Reporting ON Status to Shadow...")
-		mqttc.publish(SHADOW_UPDATE_TOPIC,SHADOW_STATE_DOC_Camera_ON,qos=1)
+		publisher.report_document(SHADOW_STATE_DOC_Camera_ON)
 	elif DESIRED_Camera_STATUS == "OFF":
 		# Turn Camera OFF
 		print("\nTurning OFF Camera...")
 		os.remove(snapshot)
 		# Report Camera OFF Status back to Shadow
 		print("Camera Turned OFF. Reporting OFF Status to Shadow...")
-		mqttc.publish(SHADOW_UPDATE_TOPIC,SHADOW_STATE_DOC_Camera_OFF,qos=1)
+		publisher.report_document(SHADOW_STATE_DOC_Camera_OFF)
 	else:
 		print("---ERROR--- Invalid Camera STATUS.")
 
@@ -155,4 +159,12 @@ mqttc.tls_set(CA_ROOT_CERT_FILE, certfile=THING_CERT_FILE, keyfile=THING_PRIVATE
 mqttc.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE_INTERVAL)
 
 # Continue monitoring the incoming messages for subscribed topic
-mqttc.loop_forever()
+try:
+    mqttc.loop_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    # Send the state reported last, the network loop must run to get its PUBACK
+    mqttc.loop_start()
+    publisher.close()
+    mqttc.loop_stop()
@@ -9,6 +9,8 @@ import sys
 import ssl
 import json
 import paho.mqtt.client as mqtt
+from shadow_publisher import ShadowPublisher
+from outbox import Outbox
 
 # for motion sensor
 import RPi.GPIO as GPIO
@@ -51,7 +53,6 @@ SHADOW_STATE_DOC_Camera_OFF = """{"state" : {"reported" : {"Camera" : "OFF"}}}""
 mqttc = mqtt.Client(client_id="Bing")
 
 
-
 #called while client tries to establish connection with the server
 def on_connect(mqttc, obj, flags, rc):
     if rc==0:
@@ -73,6 +74,14 @@ mqttc.on_connect = on_connect
 mqttc.on_subscribe = on_subscribe
 mqttc.on_message = on_message
 
+# Keeps the readings in a SQLite file until the broker acknowledged them, so the
+# readings taken while offline are sent after reconnecting. It chains the
+# callbacks above, so it comes after them
+outbox = Outbox("outbox.db", mqttc)
+
+# Merges the reported state changes of a burst into one shadow update
+publisher = ShadowPublisher(mqttc, SHADOW_UPDATE_TOPIC, outbox=outbox)
+
 
 # Configure TLS Set
 mqttc.tls_set(CA_ROOT_CERT_FILE, certfile=THING_CERT_FILE, keyfile=THING_PRIVATE_KEY_FILE, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLSv1_2, ciphers=None)
@@ -97,16 +106,17 @@ try:
         data={}
         data['motion']=i
         data['time']=datetime.now().strftime('%Y/%m/%d %H:%M:%s')
-        playload = '{"state":{"reported":'+json.dumps(data)+'}}'
-        print(playload)
+        print(data)
 
         #the topic to publish to
         #the names of these topics start with $aws/things/thingName/shadow.
-        msg_info = mqttc.publish(SHADOW_UPDATE_TOPIC, playload, qos=1)
+        publisher.report(data)
 
         time.sleep(5)
 
 except KeyboardInterrupt:
     pass
 
+publisher.close()
+outbox.close()
 GPIO.cleanup()
@@ -8,6 +8,7 @@
 import paho.mqtt.client as mqtt
 import RPi.GPIO as GPIO
 import ssl, time, sys, json
+from shadow_publisher import ShadowPublisher
 
 # =======================================================
 # Set Following Variables
@@ -49,6 +50,9 @@ GPIO.setup(LED_PIN, GPIO.OUT)
 # Initiate MQTT Client
 mqttc = mqtt.Client("Bing_2")
 
+# Merges the reported state changes of a burst into one shadow update
+publisher = ShadowPublisher(mqttc, SHADOW_UPDATE_TOPIC)
+
 
 # Master LED Control Function
 def LED_Status_Change(Shadow_State_Doc, Type):
@@ -69,14 +73,14 @@ def LED_Status_Change(Shadow_State_Doc, Type):
 		GPIO.output(LED_PIN, GPIO.HIGH)
 		# Report LED ON Status back to Shadow
 		print("LED Turned ON. Reporting ON Status to Shadow...")
-		mqttc.publish(SHADOW_UPDATE_TOPIC,SHADOW_STATE_DOC_LED_ON,qos=1)
+		publisher.report_document(SHADOW_STATE_DOC_LED_ON)
 	elif DESIRED_LED_STATUS == "OFF":
 		# Turn LED OFF
 		print("\nTurning OFF LED...")
 		GPIO.output(LED_PIN, GPIO.LOW)
 		# Report LED OFF Status back to Shadow
 		print("LED Turned OFF. Reporting OFF Status to Shadow...")
-		mqttc.publish(SHADOW_UPDATE_TOPIC,SHADOW_STATE_DOC_LED_OFF,qos=1)
+		publisher.report_document(SHADOW_STATE_DOC_LED_OFF)
 	else:
 		print("---ERROR--- Invalid LED STATUS.")
 
@@ -151,4 +155,12 @@ mqttc.tls_set(CA_ROOT_CERT_FILE, certfile=THING_CERT_FILE, keyfile=THING_PRIVATE
 mqttc.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE_INTERVAL)
 
 # Continue monitoring the incoming messages for subscribed topic
-mqttc.loop_forever()
+try:
+    mqttc.loop_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    # Send the state reported last, the network loop must run to get its PUBACK
+    mqttc.loop_start()
+    publisher.close()
+    mqttc.loop_stop()
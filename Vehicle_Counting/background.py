@@ -0,0 +1,134 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Interchangeable background models for the counting pipeline
+# ------------------------------------------
+import cv2
+import numpy as np
+
+# ============================================================================
+# Every model has the interface of the OpenCV background subtractors:
+#
+#   fg_mask = model.apply(frame, fg_mask=None, learning_rate=-1)
+#
+# frame is a BGR image, fg_mask an optional preallocated 8 bit single channel
+# buffer of the frame size that the foreground (255) is written into, and
+# learning_rate how fast the model adapts: 0 never, 1 replaces the model by
+# this frame, negative for the default of the model.
+# ============================================================================
+
+def _create_mog():
+    # OpenCV 2.4 has it in cv2, later versions only in the contrib bgsegm module
+    if hasattr(cv2, "BackgroundSubtractorMOG"):
+        return cv2.BackgroundSubtractorMOG()
+    return cv2.bgsegm.createBackgroundSubtractorMOG()
+
+
+def _create_mog2():
+    # No shadow detection: it costs time and marks shadows grey, not foreground
+    if hasattr(cv2, "createBackgroundSubtractorMOG2"):
+        return cv2.createBackgroundSubtractorMOG2(detectShadows = False)
+    return cv2.BackgroundSubtractorMOG2(500, 16, False)
+
+# ============================================================================
+
+class RunningAverageModel(object):
+    """Background as a running average of grey frames, foreground by absolute difference.
+
+    The same idea as Motion_Detection/motion_detector.py, but the reference
+    keeps adapting instead of being the first frame.
+    """
+    name = "average"
+
+    def __init__(self, threshold=25, default_rate=0.05, blur=5):
+        self.threshold = threshold
+        self.default_rate = default_rate
+        self.blur = blur
+
+        self.background = None
+        self.grey = None
+        self.blurred = None
+        self.reference = None
+        self.delta = None
+
+    def apply(self, frame, fg_mask=None, learning_rate=-1):
+        if frame.ndim == 3:
+            self.grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst = self.grey)
+            grey = self.grey
+        else:
+            grey = frame
+        if self.blur:
+            self.blurred = cv2.GaussianBlur(grey, (self.blur, self.blur), 0, dst = self.blurred)
+            grey = self.blurred
+
+        if self.background is None or self.background.shape != grey.shape:
+            self.background = grey.astype(np.float32)
+            learning_rate = 0.0
+
+        rate = self.default_rate if learning_rate < 0 else learning_rate
+
+        self.reference = cv2.convertScaleAbs(self.background, dst = self.reference)
+        self.delta = cv2.absdiff(grey, self.reference, dst = self.delta)
+        _, fg_mask = cv2.threshold(self.delta, self.threshold, 255, cv2.THRESH_BINARY, dst = fg_mask)
+
+        if rate > 0:
+            cv2.accumulateWeighted(grey, self.background, rate)
+        return fg_mask
+
+
+class DownscaledGreyModel(object):
+    """Run another model on a smaller grey copy of the frame.
+
+    The mask is scaled back up to the frame size, so the rest of the pipeline
+    does not notice. Most of the cost of MOG is per pixel and per channel, so
+    half the size in grey is about a twelfth of the work.
+    """
+    def __init__(self, model, scale=0.5):
+        self.model = model
+        self.scale = scale
+        self.name = model.name + "-grey-small"
+
+        self.grey = None
+        self.small = None
+        self.small_mask = None
+
+    def apply(self, frame, fg_mask=None, learning_rate=-1):
+        height, width = frame.shape[:2]
+        size = (max(1, int(width * self.scale)), max(1, int(height * self.scale)))
+
+        if frame.ndim == 3:
+            self.grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst = self.grey)
+        else:
+            self.grey = frame
+        self.small = cv2.resize(self.grey, size, dst = self.small, interpolation = cv2.INTER_AREA)
+
+        self.small_mask = self.model.apply(self.small, self.small_mask, learning_rate)
+        return cv2.resize(self.small_mask, (width, height), dst = fg_mask
+            , interpolation = cv2.INTER_NEAREST)
+
+
+class OpenCVModel(object):
+    """One of the OpenCV background subtractors."""
+    def __init__(self, name, subtractor):
+        self.name = name
+        self.subtractor = subtractor
+
+    def apply(self, frame, fg_mask=None, learning_rate=-1):
+        return self.subtractor.apply(frame, fg_mask, learning_rate)
+
+# ============================================================================
+
+BACKGROUND_MODELS = {
+    "mog": lambda: OpenCVModel("mog", _create_mog()),
+    "mog2": lambda: OpenCVModel("mog2", _create_mog2()),
+    "average": lambda: RunningAverageModel(),
+    "mog-grey-small": lambda: DownscaledGreyModel(OpenCVModel("mog", _create_mog())),
+}
+
+
+def create_background_model(name):
+    if name not in BACKGROUND_MODELS:
+        raise ValueError("Unknown background model '%s'" % name)
+    return BACKGROUND_MODELS[name]()
+
+# ============================================================================
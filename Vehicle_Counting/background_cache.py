@@ -0,0 +1,187 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Keep a background image per camera on disk, to warm start the background model
+# ------------------------------------------
+import logging
+import os
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# ============================================================================
+
+CACHE_FILE_FORMAT = "background_%s.npz"
+
+# The background is a blurry average, JPEG keeps it small without visible loss
+CACHE_JPEG_QUALITY = 90
+
+# OpenCV 2.4 only has some of these flags under cv2.cv
+IMWRITE_JPEG_QUALITY = getattr(cv2, "IMWRITE_JPEG_QUALITY", 1)
+
+# ============================================================================
+
+def cache_path(directory, image_source):
+    """The cache file of a camera index, video file or stream URL."""
+    key = re.sub(r"[^0-9A-Za-z]+", "_", str(image_source)).strip("_") or "default"
+    return os.path.join(directory, CACHE_FILE_FORMAT % key)
+
+
+def mean_brightness(image):
+    channels = cv2.mean(image)[:image.shape[2] if image.ndim == 3 else 1]
+    return sum(channels) / len(channels)
+
+# ============================================================================
+
+class BackgroundCache(object):
+    """A slowly updated average of the frames of a camera, saved as a small JPEG.
+
+    At the start of a session the cached image trains the background model,
+    unless it is older than `max_age` seconds, has another size than the
+    frames, or its mean brightness is more than `max_brightness_change` grey
+    levels away from the first frame (the light changed since). Then the
+    first frame trains the model instead.
+
+    While counting, every `sample_every`th frame is blended into the average
+    with weight `rate`, and the average is saved every `save_interval` seconds
+    and when the session is closed. The counting thread only takes a copy of
+    the average, a thread of its own encodes and writes it.
+    """
+    def __init__(self, path, max_age=6 * 3600, max_brightness_change=20.0, save_interval=60.0
+        , sample_every=15, rate=0.05):
+        self.log = logging.getLogger("background_cache")
+
+        self.path = path
+        self.max_age = max_age
+        self.max_brightness_change = max_brightness_change
+        self.save_interval = save_interval
+        self.sample_every = max(1, sample_every)
+        self.rate = rate
+
+        self.average = None
+        self.frames = 0
+        self.saved_at = time.time()
+
+        # The newest (image, saved_at) waiting to be written, and the thread writing it
+        self.cond = threading.Condition()
+        self.pending = None
+        self.closing = False
+        self.writer = None
+
+    def load(self):
+        """The cached (image, time it was saved), or None if there is no usable cache file."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                data = np.load(f)
+                image = cv2.imdecode(data["image"], 1)
+                saved_at = float(data["saved_at"])
+        except Exception as e:
+            self.log.warning("Unable to read the background cache '%s': %s", self.path, e)
+            return None
+        if image is None:
+            self.log.warning("Background cache '%s' holds no image.", self.path)
+            return None
+        return image, saved_at
+
+    def is_fresh(self, image, saved_at, frame):
+        age = time.time() - saved_at
+        if age > self.max_age:
+            self.log.info("Cached background is %d s old, too old.", age)
+            return False
+        if image.shape != frame.shape:
+            self.log.info("Cached background is %s, the frames are %s.", image.shape, frame.shape)
+            return False
+        change = abs(mean_brightness(image) - mean_brightness(frame))
+        if change > self.max_brightness_change:
+            self.log.info("Brightness changed by %.1f since the background was cached.", change)
+            return False
+        return True
+
+    def warm_start(self, bg_subtractor, frame):
+        """Train the model on the cached background, or on this first frame. True if the cache was used."""
+        cached = self.load()
+        if cached is not None and self.is_fresh(cached[0], cached[1], frame):
+            self.log.debug("Warm starting from the cached background '%s'...", self.path)
+            background = cached[0]
+        else:
+            self.log.debug("Training the background model on the first frame...")
+            background = frame
+        bg_subtractor.apply(background, None, 1.0)
+        self.average = background.astype(np.float32)
+        return background is not frame
+
+    def observe(self, frame, bg_subtractor):
+        """Called with every analysed frame, before the model is applied to it."""
+        if self.average is None:
+            self.warm_start(bg_subtractor, frame)
+        self.frames += 1
+        if self.frames % self.sample_every != 0:
+            return
+
+        cv2.accumulateWeighted(frame, self.average, self.rate)
+        if time.time() - self.saved_at >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """Hand a copy of the average to the writer thread, an older one not written yet is replaced."""
+        if self.average is None:
+            return
+        self.saved_at = time.time()
+        with self.cond:
+            self.pending = (cv2.convertScaleAbs(self.average), self.saved_at)
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run, name="background_cache")
+                self.writer.daemon = True
+                self.writer.start()
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closing:
+                    self.cond.wait()
+                if self.pending is None:
+                    return
+                image, saved_at = self.pending
+                self.pending = None
+            self._write(image, saved_at)
+
+    def _write(self, image, saved_at):
+        ok, encoded = cv2.imencode(".jpg", image, [IMWRITE_JPEG_QUALITY, CACHE_JPEG_QUALITY])
+        if not ok:
+            self.log.error("Unable to encode the background for '%s'.", self.path)
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Write aside and rename, so a crash never leaves a broken cache behind
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                np.savez(f, image=encoded, saved_at=saved_at)
+                f.flush()
+                os.fsync(f.fileno())
+            # os.replace also overwrites on Windows, Python 2 only has rename
+            getattr(os, "replace", os.rename)(temp_path, self.path)
+        except (IOError, OSError) as e:
+            self.log.error("Unable to write the background cache '%s': %s", self.path, e)
+            return
+        self.log.debug("Saved the background to '%s'.", self.path)
+
+    def close(self):
+        """Save the average a last time, and wait until it is written."""
+        self.save()
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+# ============================================================================
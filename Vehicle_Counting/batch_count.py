@@ -0,0 +1,145 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Count vehicles in many video files with a pool of worker processes,
+# ---              one result row per file. Re-running resumes after the last finished file.
+# ------------------------------------------
+import logging
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import time
+
+import main as counting
+
+# ============================================================================
+
+RESULT_FIELDS = ["video", "status", "count", "during", "frequency", "wall_time"]
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# ============================================================================
+
+def read_manifest(manifest):
+    """One video path per line, blank lines and # comments are ignored."""
+    videos = []
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                videos.append(line)
+    return videos
+
+
+def collect_videos(patterns, manifest=None):
+    videos = []
+    for pattern in patterns or []:
+        videos.extend(sorted(glob.glob(pattern)))
+    if manifest is not None:
+        videos.extend(read_manifest(manifest))
+
+    # Keep the first occurrence of every file
+    seen = set()
+    return [v for v in videos if not (v in seen or seen.add(v))]
+
+
+def read_done(output):
+    """The videos already counted successfully by a previous run."""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output) as f:
+        for row in csv.DictReader(f):
+            if row.get("status") == STATUS_DONE:
+                done.add(row["video"])
+    return done
+
+# ============================================================================
+
+def init_worker():
+    # Workers never show or annotate anything, and recounting a file always gives the
+    # same result, so no cached background from an earlier run
+    counting.HEADLESS = True
+    counting.SAVE_TO_FRAME = False
+    counting.BG_CACHE_DIR = None
+
+
+def count_file(video):
+    log = logging.getLogger("count_file")
+    began = time.time()
+    try:
+        cnt, during = counting.main(video)
+    except Exception:
+        log.exception("Counting '%s' failed.", video)
+        return {"video": video, "status": STATUS_FAILED, "count": "", "during": ""
+            , "frequency": "", "wall_time": "%.3f" % (time.time() - began)}
+
+    fqs = cnt * 1.0 / during if during else 0.0
+    return {"video": video, "status": STATUS_DONE, "count": cnt, "during": "%.3f" % during
+        , "frequency": "%f" % fqs, "wall_time": "%.3f" % (time.time() - began)}
+
+# ============================================================================
+
+def run_batch(videos, output, workers=None):
+    """Count every video not yet marked done in `output`, appending a row per file.
+
+    Rows are flushed as soon as a file finishes, so a crashed batch is resumed
+    by running it again. Failed files are retried on the next run.
+    """
+    log = logging.getLogger("run_batch")
+
+    done = read_done(output)
+    pending = [v for v in videos if v not in done]
+    log.info("%d videos, %d already done, %d to count with %s workers..."
+        , len(videos), len(videos) - len(pending), len(pending), workers or "all")
+    if not pending:
+        return 0
+
+    write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+    counted = 0
+    with open(output, "a") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if write_header:
+            writer.writeheader()
+            f.flush()
+
+        pool = multiprocessing.Pool(workers, initializer=init_worker)
+        try:
+            for row in pool.imap_unordered(count_file, pending):
+                writer.writerow(row)
+                f.flush()
+                counted += 1
+                log.info("[%d/%d] %s: %s, count=%s, wall time=%ss", counted, len(pending)
+                    , row["video"], row["status"], row["count"], row["wall_time"])
+        finally:
+            pool.close()
+            pool.join()
+
+    return counted
+
+# ============================================================================
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Count vehicles in many video files")
+    ap.add_argument("-g", "--glob", nargs="+", help="Glob pattern(s) of the video files")
+    ap.add_argument("-m", "--manifest", help="A file listing one video path per line")
+    ap.add_argument("-o", "--output", default="batch_results.csv", help="The CSV result file")
+    ap.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count()
+        , help="The number of worker processes")
+    args = ap.parse_args()
+    if args.glob is None and args.manifest is None:
+        ap.error("Please give either --glob or --manifest")
+    return args
+
+# ============================================================================
+
+if __name__ == "__main__":
+    args = parse_args()
+    log = counting.init_logging()
+    # Per-frame debug output from a pool of workers is unreadable anyway
+    log.setLevel(logging.INFO)
+
+    run_batch(collect_videos(args.glob, args.manifest), args.output, args.workers)
@@ -0,0 +1,86 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Compare the background models by speed and final count on the bundled videos
+# ------------------------------------------
+import logging
+import argparse
+import glob
+import time
+
+import cv2
+
+import main as counting
+from background import BACKGROUND_MODELS
+from vehicle_counter import VehicleCounter
+
+# ============================================================================
+
+class TimedModel(object):
+    """Adds up the time spent in the apply() of a background model."""
+    def __init__(self, model):
+        self.model = model
+        self.seconds = 0.0
+        self.calls = 0
+
+    def apply(self, frame, fg_mask=None, learning_rate=-1):
+        start = time.time()
+        fg_mask = self.model.apply(frame, fg_mask, learning_rate)
+        self.seconds += time.time() - start
+        self.calls += 1
+        return fg_mask
+
+# ============================================================================
+
+def bench_video(video, model_name):
+    """Count a video with a background model.
+
+    Returns (ms per frame in the model, ms per frame overall, frames, final count).
+    """
+    counting.BG_MODEL = model_name
+    model = TimedModel(counting.create_bg_subtractor())
+
+    cap = cv2.VideoCapture(video)
+    context = counting.FrameContext()
+    car_counter = None
+    frames = 0
+    frame = None
+
+    start = time.time()
+    while True:
+        ret, frame, _ = counting.read_frame(cap, 1, frame)
+        if not ret:
+            break
+        if car_counter is None:
+            car_counter = VehicleCounter(frame.shape[:2], frame.shape[0] / 2)
+        counting.process_frame(frames, frame, model, car_counter, context)
+        frames += 1
+    seconds = time.time() - start
+    cap.release()
+
+    frames = max(1, frames)
+    count = car_counter.vehicle_count if car_counter is not None else 0
+    return 1000.0 * model.seconds / frames, 1000.0 * seconds / frames, frames, count
+
+# ============================================================================
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark the background models on video files")
+    ap.add_argument("-g", "--glob", default="video/*.avi", help="Glob pattern of the video files")
+    ap.add_argument("-m", "--models", nargs="+", default=sorted(BACKGROUND_MODELS)
+        , choices=sorted(BACKGROUND_MODELS), help="The background models to compare")
+    return ap.parse_args()
+
+# ============================================================================
+
+if __name__ == "__main__":
+    args = parse_args()
+    log = counting.init_logging()
+    log.setLevel(logging.INFO)
+    counting.HEADLESS = True
+
+    for video in sorted(glob.glob(args.glob)):
+        for name in args.models:
+            model_ms, total_ms, frames, count = bench_video(video, name)
+            log.info("%s %-15s %5d frames %8.3f ms/frame in the model %8.3f ms/frame overall %5d vehicles"
+                , video, name, frames, model_ms, total_ms, count)
@@ -0,0 +1,82 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Compare the speed of the blob detectors on the bundled videos
+# ------------------------------------------
+import logging
+import argparse
+import glob
+import time
+
+import cv2
+
+import main as counting
+
+# ============================================================================
+
+def bench_video(video, detectors):
+    """Run every detector on the same foreground masks of a video.
+
+    Returns {detector: (seconds, frames, matches)} plus the number of frames
+    on which all the detectors found the same boxes.
+    """
+    cap = cv2.VideoCapture(video)
+    bg_subtractor = counting.create_bg_subtractor()
+    context = counting.FrameContext()
+
+    results = dict((name, [0.0, 0, 0]) for name in detectors)
+    agree = 0
+    frame = None
+    while True:
+        ret, frame, _ = counting.read_frame(cap, 1, frame)
+        if not ret:
+            break
+
+        region = frame if counting.ROI is None else counting.ROI.crop(frame)
+        fg_mask = bg_subtractor.apply(region, context.mask_buffer(region), 0.01)
+        fg_mask = counting.filter_mask(fg_mask, context)
+
+        boxes = []
+        for name in detectors:
+            # findContours may modify its input, every detector gets its own copy
+            mask = fg_mask.copy()
+            start = time.time()
+            matches = counting.DETECTORS[name](mask, context)
+            results[name][0] += time.time() - start
+            results[name][1] += 1
+            results[name][2] += len(matches)
+            boxes.append(sorted(box for (box, _) in matches))
+
+        if all(b == boxes[0] for b in boxes):
+            agree += 1
+
+    cap.release()
+    return results, agree
+
+# ============================================================================
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark the blob detectors on video files")
+    ap.add_argument("-g", "--glob", default="video/*.avi", help="Glob pattern of the video files")
+    ap.add_argument("-d", "--detectors", nargs="+", default=sorted(counting.DETECTORS)
+        , choices=sorted(counting.DETECTORS), help="The detectors to compare")
+    return ap.parse_args()
+
+# ============================================================================
+
+if __name__ == "__main__":
+    args = parse_args()
+    log = counting.init_logging()
+    log.setLevel(logging.INFO)
+
+    if "components" in args.detectors and not hasattr(cv2, "connectedComponentsWithStats"):
+        log.error("The components detector needs OpenCV 3.0 or later.")
+        args.detectors.remove("components")
+
+    for video in sorted(glob.glob(args.glob)):
+        results, agree = bench_video(video, args.detectors)
+        for name in args.detectors:
+            seconds, frames, matches = results[name]
+            log.info("%s %-10s %5d frames %8.3f ms/frame %6d vehicles found"
+                , video, name, frames, 1000.0 * seconds / max(1, frames), matches)
+        log.info("%s detectors agree on %d frames", video, agree)
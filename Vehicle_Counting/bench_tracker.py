@@ -0,0 +1,88 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Compare the speed of the tracker assigners, with and without the grid, on synthetic traffic
+# ------------------------------------------
+import logging
+import argparse
+import math
+import random
+import sys
+import time
+
+import vehicle_counter
+from vehicle_counter import VehicleCounter, ASSIGNERS
+
+# ============================================================================
+
+# When the tracker switches to the grid, see vehicle_counter.GRID_MIN_PAIRS
+DEFAULT_GRID_MIN_PAIRS = (vehicle_counter.GRID_MIN_PAIRS, vehicle_counter.GRID_MIN_PAIRS_NUMPY)
+
+# ============================================================================
+
+def synthetic_frames(tracks, frames, seed=0, spacing=60, miss=0.05):
+    """The matches of `tracks` vehicles driving down the frame, for `frames` frames.
+
+    The vehicles start on a grid `spacing` pixels apart and move 3 to 8 pixels
+    per frame, each match is missed with probability `miss`, and the matches
+    of a frame come in random order. Returns (frame shape, list of matches).
+    """
+    rng = random.Random(seed)
+    side = int(math.ceil(math.sqrt(tracks)))
+    height = width = side * spacing
+
+    positions = [((i % side) * spacing + spacing // 2, (i // side) * spacing + spacing // 2)
+        for i in range(tracks)]
+    speeds = [(rng.randint(-1, 1), rng.randint(3, 8)) for _ in range(tracks)]
+
+    all_matches = []
+    for _ in range(frames):
+        positions = [(x + dx, (y + dy) % height) for ((x, y), (dx, dy)) in zip(positions, speeds)]
+        matches = [((x - 10, y - 10, 20, 20), (x, y)) for (x, y) in positions if rng.random() >= miss]
+        rng.shuffle(matches)
+        all_matches.append(matches)
+    return (height, width), all_matches
+
+
+def bench_assigner(assigner, shape, all_matches, grid=True):
+    """Returns (seconds per frame, vehicles counted) of the assigner on the matches.
+
+    Without `grid` every vehicle is compared with every match.
+    """
+    vehicle_counter.GRID_MIN_PAIRS, vehicle_counter.GRID_MIN_PAIRS_NUMPY = \
+        DEFAULT_GRID_MIN_PAIRS if grid else (sys.maxsize, sys.maxsize)
+    car_counter = VehicleCounter(shape, shape[0] / 2, 1, assigner)
+    # The first frame only creates the vehicles
+    car_counter.update_count(list(all_matches[0]))
+
+    start = time.time()
+    for matches in all_matches[1:]:
+        car_counter.update_count(list(matches))
+    seconds = time.time() - start
+    return seconds / max(1, len(all_matches) - 1), car_counter.vehicle_count
+
+# ============================================================================
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark the tracker assigners on synthetic traffic")
+    ap.add_argument("-n", "--tracks", type=int, nargs="+", default=[5, 50, 500]
+        , help="The numbers of vehicles tracked at once")
+    ap.add_argument("-f", "--frames", type=int, default=30, help="The number of frames per run")
+    ap.add_argument("-a", "--assigners", nargs="+", default=list(ASSIGNERS), choices=ASSIGNERS
+        , help="The assigners to compare")
+    return ap.parse_args()
+
+# ============================================================================
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    log = logging.getLogger("bench_tracker")
+
+    for tracks in args.tracks:
+        shape, all_matches = synthetic_frames(tracks, args.frames)
+        for assigner in args.assigners:
+            for grid in (False, True):
+                seconds, count = bench_assigner(assigner, shape, all_matches, grid)
+                log.info("%4d tracks %-10s %-4s %9.3f ms/frame %6d vehicles counted"
+                    , tracks, assigner, "grid" if grid else "scan", 1000.0 * seconds, count)
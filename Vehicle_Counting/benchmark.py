@@ -0,0 +1,244 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Benchmark the counting pipeline on the bundled videos, and compare two results
+# ---
+# --- Run:      python benchmark.py -g "video/*.avi" -r 3 -o baseline.json
+# --- Compare:  python benchmark.py --compare baseline.json candidate.json -t 10
+# ------------------------------------------
+import logging
+import argparse
+import glob
+import json
+import multiprocessing
+import platform
+import sys
+import time
+
+import cv2
+
+import main as counting
+from metrics import METRICS
+from scoring import truth_path, load_truth, score
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, the peak RSS is then reported as 0
+    resource = None
+
+# ============================================================================
+
+# Metric -> True if higher is better. Regressions are changes in the wrong
+# direction by more than the threshold.
+COMPARED_METRICS = [
+    ("fps", True),
+    ("frame_p50_ms", False),
+    ("frame_p95_ms", False),
+    ("frame_p99_ms", False),
+    ("peak_rss_kb", False),
+    ("precision", True),
+    ("recall", True),
+]
+
+# ============================================================================
+
+def peak_rss_kb():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+# ============================================================================
+
+def init_worker():
+    # Nothing on screen or disk, and no cached background, so every run starts equal
+    counting.HEADLESS = True
+    counting.SAVE_TO_FRAME = False
+    counting.BG_CACHE_DIR = None
+    counting.RECORD_COUNTS = True
+
+
+def run_once(video):
+    """Count a video in this (fresh) process, returns the measurements of the run."""
+    began = time.time()
+    count, _ = counting.main(video)
+    wall_time = time.time() - began
+
+    summary = METRICS.summary()
+    # The whole frame in the sequential loop, the analysis stage in the pipeline
+    stage = summary["stages"].get("frame") or summary["stages"].get("analysis") or {}
+    run = {"video": video
+        , "count": count
+        , "frames": summary["frames"]
+        , "wall_time": round(wall_time, 3)
+        , "fps": summary["fps"]
+        , "frame_p50_ms": stage.get("p50", 0.0)
+        , "frame_p95_ms": stage.get("p95", 0.0)
+        , "frame_p99_ms": stage.get("p99", 0.0)
+        , "peak_rss_kb": peak_rss_kb()
+        , "stages": summary["stages"]}
+
+    # Accuracy against the ground truth, for the clips that have one
+    truth = load_truth(truth_path(video))
+    if truth is not None:
+        run.update(score(counting.COUNTED_FRAMES, truth))
+    return run
+
+
+def summarise(runs):
+    """The medians over the runs of a video, the worst peak RSS, and every count seen."""
+    counts = sorted(set(run["count"] for run in runs))
+    result = {"runs": len(runs)
+        , "count": runs[0]["count"]
+        , "counts": counts
+        , "frames": runs[0]["frames"]
+        , "peak_rss_kb": max(run["peak_rss_kb"] for run in runs)}
+    for metric in ("fps", "frame_p50_ms", "frame_p95_ms", "frame_p99_ms", "wall_time"):
+        result[metric] = round(median([run[metric] for run in runs]), 3)
+    if "precision" in runs[0]:
+        for metric in ("precision", "recall", "count_error", "count_error_pct"):
+            result[metric] = round(median([run[metric] for run in runs]), 4)
+    return result
+
+
+def run_benchmark(videos, repeats=3):
+    """Count every video `repeats` times, each run in a process of its own.
+
+    The runs are sequential, so they do not compete for the CPU, and a new
+    process per run makes the peak RSS that of that run only.
+    """
+    log = logging.getLogger("run_benchmark")
+
+    tasks = [video for video in videos for _ in range(repeats)]
+    runs = dict((video, []) for video in videos)
+
+    pool = multiprocessing.Pool(1, initializer=init_worker, maxtasksperchild=1)
+    try:
+        for run in pool.imap(run_once, tasks):
+            runs[run["video"]].append(run)
+            log.info("%s: count=%d, %.1f fps, p95=%.3f ms, peak RSS=%d KB", run["video"]
+                , run["count"], run["fps"], run["frame_p95_ms"], run["peak_rss_kb"])
+            if "precision" in run:
+                log.info("%s: precision=%.3f, recall=%.3f, count error=%+d (%+.1f%%)", run["video"]
+                    , run["precision"], run["recall"], run["count_error"], run["count_error_pct"])
+    finally:
+        pool.close()
+        pool.join()
+
+    return {"meta": {"time": time.strftime("%Y-%m-%d %H:%M:%S")
+            , "python": platform.python_version()
+            , "opencv": cv2.__version__
+            , "machine": platform.machine()
+            , "repeats": repeats
+            , "pipeline": counting.PIPELINE_MODE
+            , "detector": counting.DETECTOR
+            , "bg_model": counting.BG_MODEL}
+        , "videos": dict((video, summarise(runs[video])) for video in videos)}
+
+# ============================================================================
+
+def compare(baseline, candidate, threshold=10.0):
+    """The regressions of candidate against baseline, as (video, metric, baseline, candidate, change %).
+
+    A count that differs at all is a regression, the other metrics when they
+    got worse by more than `threshold` percent.
+    """
+    regressions = []
+    for video, base in sorted(baseline["videos"].items()):
+        new = candidate["videos"].get(video)
+        if new is None:
+            continue
+        if new["count"] != base["count"]:
+            regressions.append((video, "count", base["count"], new["count"], None))
+
+        for metric, higher_is_better in COMPARED_METRICS:
+            before, after = base.get(metric), new.get(metric)
+            if not before or after is None:
+                continue
+            change = 100.0 * (after - before) / before
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((video, metric, before, after, change))
+    return regressions
+
+
+def report_comparison(baseline, candidate, threshold):
+    log = logging.getLogger("compare")
+
+    for video, base in sorted(baseline["videos"].items()):
+        new = candidate["videos"].get(video)
+        if new is None:
+            log.warning("%s is missing from the candidate.", video)
+            continue
+        log.info("%s: count %s -> %s, %.1f -> %.1f fps, p95 %.3f -> %.3f ms, peak RSS %d -> %d KB"
+            , video, base["count"], new["count"], base["fps"], new["fps"]
+            , base["frame_p95_ms"], new["frame_p95_ms"], base["peak_rss_kb"], new["peak_rss_kb"])
+        if "precision" in base and "precision" in new:
+            log.info("%s: precision %.3f -> %.3f, recall %.3f -> %.3f, count error %+d -> %+d"
+                , video, base["precision"], new["precision"], base["recall"], new["recall"]
+                , base["count_error"], new["count_error"])
+
+    regressions = compare(baseline, candidate, threshold)
+    for video, metric, before, after, change in regressions:
+        if change is None:
+            log.error("REGRESSION %s: %s changed from %s to %s", video, metric, before, after)
+        else:
+            log.error("REGRESSION %s: %s %s -> %s (%+.1f%%)", video, metric, before, after, change)
+    if not regressions:
+        log.info("No regressions beyond %.1f%%.", threshold)
+    return regressions
+
+# ============================================================================
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark the vehicle counting on video files")
+    ap.add_argument("-g", "--glob", nargs="+", default=["video/*.avi"], help="Glob pattern(s) of the video files")
+    ap.add_argument("-r", "--repeats", type=int, default=3, help="The number of runs per video")
+    ap.add_argument("-o", "--output", default="benchmark.json", help="The JSON result file")
+    ap.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE")
+        , help="Compare two result files instead of running the benchmark")
+    ap.add_argument("-t", "--threshold", type=float, default=10.0
+        , help="The change in percent that counts as a regression")
+    ap.add_argument("--pipeline", help="Benchmark the threaded pipeline", action="store_true")
+    ap.add_argument("--detector", choices=sorted(counting.DETECTORS), help="The blob detector to benchmark")
+    ap.add_argument("--bgModel", choices=sorted(counting.BACKGROUND_MODELS), help="The background model to benchmark")
+    return ap.parse_args()
+
+# ============================================================================
+
+if __name__ == "__main__":
+    args = parse_args()
+    log = counting.init_logging()
+    log.setLevel(logging.INFO)
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            candidate = json.load(f)
+        sys.exit(1 if report_comparison(baseline, candidate, args.threshold) else 0)
+
+    # Set before the workers fork, so they inherit them
+    counting.PIPELINE_MODE = args.pipeline
+    if args.detector is not None:
+        counting.DETECTOR = args.detector
+    if args.bgModel is not None:
+        counting.BG_MODEL = args.bgModel
+
+    videos = []
+    for pattern in args.glob:
+        videos.extend(sorted(glob.glob(pattern)))
+
+    results = run_benchmark(videos, args.repeats)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    log.info("Results written to '%s'.", args.output)
@@ -0,0 +1,273 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Compact archive of debug frames, instead of one PNG per frame and kind
+# ---
+# --- Layout of an archive directory:
+# ---   <kind>_00000.avi   colour frames (source, processed) appended to MJPG video segments
+# ---   mask_00000.bin     foreground masks, bit-packed and zlib compressed, one record per frame
+# ---   index.csv          session,kind,frame_number,segment,position for every stored frame
+# ---                      (session counts the runs appended to the archive, as frame numbers
+# ---                      restart at 0 in every run; position is the frame in the video segment,
+# ---                      or the byte offset in the mask chunk)
+# ------------------------------------------
+import logging
+import csv
+import os
+import struct
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+# ============================================================================
+
+MASK_KIND = "mask"
+
+INDEX_FILE = "index.csv"
+INDEX_HEADER = ["session", "kind", "frame_number", "segment", "position"]
+SEGMENT_FORMAT = "%s_%05d"
+
+# frame_number, height, width, payload length
+MASK_HEADER = struct.Struct("<IHHI")
+
+CV_CAP_PROP_POS_FRAMES = 1
+
+DEFAULT_SEGMENT_FRAMES = 1000
+
+# Seconds between two flushes of the index and the mask chunks, so a crash loses at most that much
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# ============================================================================
+
+def _fourcc(code):
+    # cv2.VideoWriter_fourcc only exists from OpenCV 3.0
+    if hasattr(cv2, "VideoWriter_fourcc"):
+        return cv2.VideoWriter_fourcc(*code)
+    return cv2.cv.CV_FOURCC(*code)
+
+
+def _to_bytes(array):
+    return array.tobytes() if hasattr(array, "tobytes") else array.tostring()
+
+
+def pack_mask(mask):
+    """Bit-pack a binary mask (any non zero pixel is foreground) and compress it."""
+    return zlib.compress(_to_bytes(np.packbits(mask > 0)), 1)
+
+
+def unpack_mask(payload, height, width):
+    bits = np.unpackbits(np.frombuffer(zlib.decompress(payload), np.uint8))
+    return (bits[:height * width].reshape(height, width) * 255).astype(np.uint8)
+
+# ============================================================================
+
+class ArchiveWriter(object):
+    """Append frames and masks to an archive directory.
+
+    Frames of every kind must be appended in increasing frame number order;
+    a new segment is started every `segment_frames` frames of a kind. The
+    frames of a writer are indexed under a session number of their own,
+    one more than the last session already in the archive.
+
+    The index and the mask chunks are flushed every `flush_interval`
+    seconds, not only when a segment closes, so the archive of a crashed
+    run can still be read up to about then.
+    """
+    def __init__(self, directory, fps=15.0, segment_frames=DEFAULT_SEGMENT_FRAMES, fourcc="MJPG"
+        , flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.log = logging.getLogger("archive_writer")
+
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.fps = fps if fps and fps > 0 else 15.0
+        self.segment_frames = max(1, segment_frames)
+        self.fourcc = _fourcc(fourcc)
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+
+        # kind -> [segment, frames in segment, writer or file]
+        self.segments = {}
+
+        index_path = os.path.join(directory, INDEX_FILE)
+        new_index = not os.path.exists(index_path)
+        self.session = 0 if new_index else self._next_session(index_path)
+        self.index_file = open(index_path, "a")
+        self.index = csv.writer(self.index_file)
+        if new_index:
+            self.index.writerow(INDEX_HEADER)
+
+    def _next_session(self, index_path):
+        with open(index_path) as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is not None and header != INDEX_HEADER:
+                raise ValueError("'%s' is not an index of this archive format, use another directory"
+                    % index_path)
+            sessions = [int(row[0]) for row in reader if row]
+        return max(sessions) + 1 if sessions else 0
+
+    def _next_segment(self, kind):
+        segments = [int(name[len(kind) + 1:-4]) for name in os.listdir(self.directory)
+            if name.startswith(kind + "_") and name[len(kind) + 1:-4].isdigit()]
+        return max(segments) + 1 if segments else 0
+
+    def _segment(self, kind, frame):
+        current = self.segments.get(kind)
+        if current is not None and current[1] < self.segment_frames:
+            return current
+
+        if current is not None:
+            self._close_segment(current)
+            segment = current[0] + 1
+        else:
+            # Never overwrite the segments of an earlier session
+            segment = self._next_segment(kind)
+
+        path = os.path.join(self.directory, SEGMENT_FORMAT % (kind, segment))
+        if kind == MASK_KIND:
+            output = open(path + ".bin", "ab")
+        else:
+            height, width = frame.shape[:2]
+            output = cv2.VideoWriter(path + ".avi", self.fourcc, self.fps, (width, height))
+        self.log.debug("Starting archive segment '%s'...", path)
+
+        current = [segment, 0, output]
+        self.segments[kind] = current
+        return current
+
+    def _close_segment(self, current):
+        output = current[2]
+        if hasattr(output, "release"):
+            output.release()
+        else:
+            output.close()
+        self.index_file.flush()
+
+    def append(self, kind, frame_number, frame):
+        current = self._segment(kind, frame)
+        segment, position, output = current
+
+        if kind == MASK_KIND:
+            position = output.tell()
+            payload = pack_mask(frame)
+            height, width = frame.shape[:2]
+            output.write(MASK_HEADER.pack(frame_number, height, width, len(payload)))
+            output.write(payload)
+        else:
+            if frame.ndim == 2:
+                frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            output.write(frame)
+
+        current[1] += 1
+        self.index.writerow([self.session, kind, frame_number, segment, position])
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Push the mask chunks, then the index rows pointing into them, to the disk."""
+        for current in self.segments.values():
+            if hasattr(current[2], "flush"):
+                current[2].flush()
+        self.index_file.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        for current in self.segments.values():
+            self._close_segment(current)
+        self.segments = {}
+        self.index_file.close()
+
+# ============================================================================
+
+class ArchiveReader(object):
+    """Random access to the frames and masks of one session of an archive directory.
+
+    The last session appended to the archive by default, see sessions().
+    """
+    def __init__(self, directory, session=None):
+        self.directory = directory
+
+        # session -> {(kind, frame_number) -> (segment, position)}
+        indexes = {}
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            for row in csv.DictReader(f):
+                try:
+                    key = (row["kind"], int(row["frame_number"]))
+                    location = (int(row["segment"]), int(row["position"]))
+                    session = int(row["session"])
+                except (TypeError, ValueError):
+                    # The last row of a crashed run can be cut short
+                    continue
+                indexes.setdefault(session, {})[key] = location
+
+        self.all_sessions = sorted(indexes)
+        if session is None and self.all_sessions:
+            session = self.all_sessions[-1]
+        if session is not None and session not in indexes:
+            raise ValueError("The archive '%s' has no session %d" % (directory, session))
+        self.session = session
+        self.index = indexes.get(session, {})
+
+        # The open video segment per kind, so sequential reads need no seek
+        self.captures = {}
+
+    def sessions(self):
+        return list(self.all_sessions)
+
+    def kinds(self):
+        return sorted(set(kind for (kind, _) in self.index))
+
+    def frame_numbers(self, kind):
+        return sorted(n for (k, n) in self.index if k == kind)
+
+    def read(self, kind, frame_number):
+        """The stored frame, or None if this frame of this kind is not in the archive."""
+        location = self.index.get((kind, frame_number))
+        if location is None:
+            return None
+        segment, position = location
+        path = os.path.join(self.directory, SEGMENT_FORMAT % (kind, segment))
+
+        if kind == MASK_KIND:
+            with open(path + ".bin", "rb") as f:
+                f.seek(position)
+                header = f.read(MASK_HEADER.size)
+                if len(header) < MASK_HEADER.size:
+                    return None
+                _, height, width, length = MASK_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    return None
+                return unpack_mask(payload, height, width)
+
+        cached = self.captures.get(kind)
+        if cached is None or cached[0] != segment or cached[2] != position:
+            if cached is None or cached[0] != segment:
+                if cached is not None:
+                    cached[1].release()
+                cached = [segment, cv2.VideoCapture(path + ".avi"), 0]
+                self.captures[kind] = cached
+            if cached[2] != position:
+                cached[1].set(CV_CAP_PROP_POS_FRAMES, position)
+                cached[2] = position
+
+        ret, frame = cached[1].read()
+        cached[2] += 1
+        return frame if ret else None
+
+    def read_frame(self, frame_number):
+        return self.read("frame", frame_number)
+
+    def read_mask(self, frame_number):
+        return self.read(MASK_KIND, frame_number)
+
+    def close(self):
+        for cached in self.captures.values():
+            cached[1].release()
+        self.captures = {}
+
+# ============================================================================
@@ -0,0 +1,125 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Write debug frames to disk from background threads
+# ------------------------------------------
+import logging
+import os
+import threading
+
+import cv2
+
+from pipeline import StageQueue, END_OF_STREAM, POLICY_DROP_OLDEST
+
+# ============================================================================
+
+# What happens to new frames when the writers fall behind
+WRITER_DROP_OLDEST = POLICY_DROP_OLDEST  # throw away the oldest queued frame
+WRITER_SAMPLE = "sample"                 # only keep every Nth frame until the queue drains
+
+WRITER_POLICIES = (WRITER_DROP_OLDEST, WRITER_SAMPLE)
+
+# OpenCV 2.4 only has some of these flags under cv2.cv
+IMWRITE_JPEG_QUALITY = getattr(cv2, "IMWRITE_JPEG_QUALITY", 1)
+IMWRITE_PNG_COMPRESSION = getattr(cv2, "IMWRITE_PNG_COMPRESSION", 16)
+
+# ============================================================================
+
+class FrameWriter(object):
+    """A pool of threads writing frames taken off a bounded queue.
+
+    The capture loop only pays for a copy of the frame, the encoding and the
+    disk write happen on the writer threads. When the queue fills up, frames
+    are dropped according to `policy` instead of stalling the caller:
+      drop-oldest  the oldest queued frame is thrown away
+      sample       once the queue is half full, only frames whose number is a
+                   multiple of `sample_every` are queued; if it is still full
+                   the new frame is thrown away
+
+    Frames go to image files by default. A `sink(file_name, frame_number, frame)`
+    returning True on success can store them elsewhere; with a single worker
+    the sink sees the frames in the order they were submitted.
+    """
+    def __init__(self, image_format="png", quality=None, maxsize=16, workers=1
+        , policy=WRITER_DROP_OLDEST, sample_every=10, sink=None):
+        if policy not in WRITER_POLICIES:
+            raise ValueError("Unknown writer policy '%s'" % policy)
+        self.log = logging.getLogger("frame_writer")
+
+        self.extension = "." + image_format.lower().lstrip(".")
+        if self.extension in (".jpg", ".jpeg"):
+            self.params = [IMWRITE_JPEG_QUALITY, 90 if quality is None else quality]
+        elif self.extension == ".png":
+            self.params = [IMWRITE_PNG_COMPRESSION, 3 if quality is None else quality]
+        else:
+            self.params = []
+
+        self.policy = policy
+        self.sample_every = max(1, sample_every)
+        self.sink = sink
+        self.queue = StageQueue("frame_writer", maxsize, POLICY_DROP_OLDEST)
+
+        self.lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.threads = [threading.Thread(target=self._run, name="frame_writer_%d" % i)
+            for i in range(max(1, workers))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def file_name(self, file_name):
+        """The file name with the extension of the configured image format."""
+        return os.path.splitext(file_name)[0] + self.extension
+
+    def submit(self, file_name, frame_number, frame):
+        """Queue a copy of the frame to be written, returns False if it was dropped."""
+        if self.policy == WRITER_SAMPLE:
+            depth = self.queue.depth()
+            if depth >= self.queue.maxsize or (depth * 2 >= self.queue.maxsize
+                    and frame_number % self.sample_every != 0):
+                with self.lock:
+                    self.dropped += 1
+                return False
+
+        # The frame buffers are reused by the counting loop, so queue a copy
+        self.queue.put((self.file_name(file_name), frame_number, frame.copy()))
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is END_OF_STREAM:
+                break
+            file_name, frame_number, frame = item
+            if self.sink is not None:
+                ok = self.sink(file_name, frame_number, frame)
+            else:
+                ok = cv2.imwrite(file_name, frame, self.params)
+            with self.lock:
+                if ok:
+                    self.written += 1
+                else:
+                    self.failed += 1
+            if not ok:
+                self.log.error("Unable to write '%s'.", file_name)
+
+    def stats(self):
+        with self.lock:
+            return {"written": self.written
+                , "dropped": self.dropped + self.queue.stats()["dropped"]
+                , "failed": self.failed
+                , "queued": self.queue.depth()}
+
+    def close(self):
+        """Write what is still queued, then stop the writer threads."""
+        for _ in self.threads:
+            self.queue.put(END_OF_STREAM)
+        for thread in self.threads:
+            thread.join()
+        self.log.info("Frames written: %(written)d, dropped: %(dropped)d, failed: %(failed)d"
+            , self.stats())
+
+# ============================================================================
@@ -8,11 +8,29 @@ import logging
 import logging.handlers
 import argparse
 import cv2
-from vehicle_counter import VehicleCounter
+import numpy as np
+from vehicle_counter import VehicleCounter, ASSIGNERS, ASSIGN_FIRST
+from pipeline import FramePipeline, POLICIES, POLICY_BLOCK
+from roi import RegionOfInterest, parse_rect, parse_polygon
+from tracing import TRACER
+from frame_writer import FrameWriter, WRITER_POLICIES, WRITER_DROP_OLDEST
+from frame_archive import ArchiveWriter
+from background import BACKGROUND_MODELS, DownscaledGreyModel, create_background_model
+from background_cache import BackgroundCache, cache_path
+from metrics import METRICS, clock
+from realtime import LatestFrameReader, DeadlineController, DegradableModel
+from realtime import LEVEL_NO_DRAWING, LEVEL_DOWNSCALE, LEVEL_SKIP_FRAMES, LEVEL_NAMES
+from session import SessionManager
+from reporting import RollingReporter
+from multi_camera import Camera, MultiCameraService, camera_names, is_live
+from motion_gate import MotionGate
+from shadow_publisher import ShadowPublisher
+from outbox import Outbox
 import paho.mqtt.client as mqtt
 import ssl, time, sys, json
 import picamera
 import os
+import signal
 from time import sleep
 
 # =======================================================
@@ -44,6 +62,14 @@ SHADOW_GET_REJECTED_TOPIC = "$aws/things/" + THING_NAME + "/shadow/get/rejected"
 snapshot = 'my_image.jpg'
 mqttc = mqtt.Client("Bing")
 
+# Merges the reported state changes of a burst into one shadow update, see initial_mqttclient
+publisher = None
+
+# Keep the shadow updates in this SQLite file until the broker acknowledged them,
+# so the reports made while offline are sent after reconnecting. None to publish directly
+OUTBOX_FILE = "outbox.db"
+outbox = None
+
 # Master Camera Control Function
 def Camera_Status_Change(Shadow_State_Doc, Type):
     log = logging.getLogger("Camera_Status_Change")
@@ -59,16 +85,10 @@ def Camera_Status_Change(Shadow_State_Doc, Type):
 
     # Control Camera
     if DESIRED_Camera_STATUS == "ON":
-        # Turn Camera ON
+        # Turn Camera ON, the session runs on the main thread and reports when it ends
         log.info("Starting counting...")
-        cnt, during= main()
-        fqs = cnt * 1.0 / during
-        log.info("The frequency is %f [%d,%d]", fqs, cnt, during)
-
-        SHADOW_STATE_DOC_Camera_ON_UPDATE = """{"state" : {"reported" : {"Counting" : "ON",""" +
-                                                                         """ "Number":""" + str(cnt) +
-                                                                         """, "During":""" + str(during) +
-                                                                         """, "Frequency": """ + str(fqs) + """}}}"""
+        if not SESSIONS.start():
+            log.info("Counting is already running, nothing to start.")
 
         # Initiate camera
         #camera = picamera.PiCamera()
@@ -79,24 +99,69 @@ def Camera_Status_Change(Shadow_State_Doc, Type):
         #camera.capture(my_file)
         #my_file.close()
         #camera.close()
-        # Report Camera ON Status back to Shadow
-        log.info("Camera Turned ON. Reporting Status to Shadow...")
-        mqttc.publish(SHADOW_UPDATE_TOPIC,SHADOW_STATE_DOC_Camera_ON_UPDATE,qos=1)
     elif DESIRED_Camera_STATUS == "OFF":
         # Turn Camera OFF
         log.info("\nTurning OFF Camera...")
+        if SESSIONS.stop():
+            # The session reports OFF with its counts once it stopped
+            return
         #os.remove(snapshot)
         # Report Camera OFF Status back to Shadow
         log.info("Camera Turned OFF. Reporting OFF Status to Shadow...")
-        SHADOW_STATE_DOC_Camera_OFF_UPDATE = """{"state" : {"reported" : {"Counting" : "OFF",""" +
+        SHADOW_STATE_DOC_Camera_OFF_UPDATE = ("""{"state" : {"reported" : {"Counting" : "OFF",""" +
                                     """ "Number":""" + str(0) +
                                     """, "During":""" + str(0) +
-                                    """, "Frequency": """+ str(0) + """}}}"""
-        mqttc.publish(SHADOW_UPDATE_TOPIC,SHADOW_STATE_DOC_Camera_OFF_UPDATE,qos=1)
+                                    """, "Frequency": """+ str(0) + """}}}""")
+        publisher.report_document(SHADOW_STATE_DOC_Camera_OFF_UPDATE)
     else:
         log.info("---ERROR--- Invalid Camera STATUS.")
 
 
+def Report_Session(result, stopped):
+    log = logging.getLogger("Report_Session")
+    if isinstance(result, dict):
+        Report_Cameras(result, stopped)
+        return
+    cnt, during = result
+    fqs = cnt * 1.0 / during if during else 0.0
+    log.info("The frequency is %f [%d,%d]", fqs, cnt, during)
+
+    # A session stopped by an OFF delta reports OFF, one that ran to the end of its source ON
+    status = "OFF" if stopped else "ON"
+    SHADOW_STATE_DOC_Session_UPDATE = ("""{"state" : {"reported" : {"Counting" : """ + json.dumps(status) +
+                                       """, "Number":""" + str(cnt) +
+                                       """, "During":""" + str(during) +
+                                       """, "Frequency": """ + str(fqs) +
+                                       """, "Metrics": """ + json.dumps(METRICS.summary()) + """}}}""")
+
+    # Report Camera Status back to Shadow
+    log.info("Camera Turned %s. Reporting Status to Shadow...", status)
+    publisher.report_document(SHADOW_STATE_DOC_Session_UPDATE)
+
+
+def Report_Cameras(results, stopped):
+    # The counts of a session of several cameras, see main_cameras
+    log = logging.getLogger("Report_Cameras")
+    status = "OFF" if stopped else "ON"
+    cameras = {}
+    for name, (cnt, during, metrics) in results.items():
+        fqs = cnt * 1.0 / during if during else 0.0
+        log.info("Camera '%s': the frequency is %f [%d,%d]", name, fqs, cnt, during)
+        # Only the frame latencies, a shadow document is limited to 8 KB and main_cameras
+        # logs the full metrics of every camera
+        frame = metrics["stages"].get("frame", {})
+        cameras[name] = {"Number": cnt, "During": during, "Frequency": fqs
+            , "Metrics": {"fps": metrics["fps"], "p50": frame.get("p50", 0.0), "p95": frame.get("p95", 0.0)}}
+
+    log.info("Cameras Turned %s. Reporting Status to Shadow...", status)
+    publisher.report({"Counting": status, "Cameras": cameras})
+
+
+def Report_Window(report):
+    # Called on the reporter thread every TIME_INTERVAL seconds while counting
+    publisher.report(report)
+
+
 
 # Define on connect event function
 # We shall subscribe to Shadow Accepted and Rejected Topics in this function
@@ -159,12 +224,17 @@ def on_disconnect(client, userdata, rc):
         log.info("Diconnected from AWS IoT. Trying to auto-reconnect...")
 
 def initial_mqttclient():
+    global publisher, outbox
     log = logging.getLogger("initial_mqttclient")
     # Register callback functions
     mqttc.on_message = on_message
     mqttc.on_connect = on_connect
     mqttc.on_subscribe = on_subscribe
     mqttc.on_disconnect = on_disconnect
+    # The outbox chains the callbacks above, so it comes after them
+    if OUTBOX_FILE:
+        outbox = Outbox(OUTBOX_FILE, mqttc)
+    publisher = ShadowPublisher(mqttc, SHADOW_UPDATE_TOPIC, outbox = outbox)
 
     # Configure TLS Set
     mqttc.tls_set(CA_ROOT_CERT_FILE, certfile=THING_CERT_FILE, keyfile=THING_PRIVATE_KEY_FILE,
@@ -177,27 +247,69 @@ def initial_mqttclient():
 # ============================================================================
 # Define global  vars
 IMAGE_DIR = "images"
+
+# Capture properties, under cv2.cv in OpenCV 2.4 and cv2.CAP_PROP_* from 3.0, the same numbers in both
+CV_CAP_PROP_FRAME_WIDTH = 3
+CV_CAP_PROP_FRAME_HEIGHT = 4
+CV_CAP_PROP_FPS = 5
 IMAGE_FILENAME_FORMAT = IMAGE_DIR + "/frame_%04d.png"
 
 # Time to wait between frames, 0=forever
 WAIT_TIME = 1 # 250 # ms
 
+# Seconds between two count reports while counting
 TIME_INTERVAL = 15
 
 # Save the log information into the local file
 LOG_TO_FILE = False
 
+# Level of the root logger
+LOG_LEVEL = "DEBUG"
+
+# Write structured contour/vehicle records into this file, SIGUSR1 toggles it at runtime
+TRACE_FILE = "trace.jsonl"
+
+# Trace from the start instead of waiting for SIGUSR1
+TRACE_ON_START = False
+
+# Fraction of the frames that are traced while tracing is on
+TRACE_FRACTION = 1.0
+
 # Save intermeidate frame into the disk for later analysis
 SAVE_TO_FRAME = False
 
+# How the intermediate frames are written, see FrameWriter
+FRAME_FORMAT = "png"
+FRAME_QUALITY = None # PNG compression level or JPEG quality, None for the default
+FRAME_QUEUE_SIZE = 16
+FRAME_WRITERS = 1
+FRAME_DROP_POLICY = WRITER_DROP_OLDEST
+FRAME_SAMPLE_EVERY = 10
+
+# Append the intermediate frames to an archive in this directory instead of one image per frame
+FRAME_ARCHIVE = None
+
+# Frames per video segment of the archive
+FRAME_ARCHIVE_SEGMENT = 1000
+
+# Writes the intermediate frames in the background while counting
+FRAME_WRITER = None
+
 # Colours for drawing on processed frames
 DIVIDER_COLOUR = (255, 255, 0)
 BOUNDING_BOX_COLOUR = (255, 0, 0)
 CENTROID_COLOUR = (0, 0, 255)
+ROI_COLOUR = (0, 255, 0)
 
 # Identify where the image source come from
 IMAGE_SOURCE = None
 
+# Count all these sources at once instead, see main_cameras
+IMAGE_SOURCES = None
+
+# The number of threads analysing the frames of IMAGE_SOURCES
+CAMERA_WORKERS = 2
+
 
 # Identify if the source come video or streaming
 CAPTURE_FROM_VIDEO = False
@@ -205,11 +317,89 @@ CAPTURE_FROM_VIDEO = False
 CAPTURE_FROM_STREAMING = False
 
 CAPTURE_FROM_PICTURE = False
+
+# Run capture, analysis and output on their own threads
+PIPELINE_MODE = False
+
+# Always analyse the newest frame and shed work when frames miss their deadline
+REALTIME_MODE = False
+
+# The deadline of a frame from its capture in real-time mode, None for one frame period
+DEADLINE_MS = None
+
+# Number of frames that can wait in front of each pipeline stage
+PIPELINE_QUEUE_SIZE = 4
+
+# What to do when the output stage falls behind, block or drop-oldest. The analysis never drops
+# a frame, the tracker would lose the vehicles
+PIPELINE_POLICY = POLICY_BLOCK
+
+# Run without any window, for Pis that have no display attached
+HEADLESS = False
+
+# Analyse only every Nth frame of the source, 1 analyses every frame
+SAMPLE_STRIDE = 1
+
+# Or analyse one frame per this many milliseconds of video, overrides SAMPLE_STRIDE
+SAMPLE_PERIOD_MS = None
+
+# Only analyse this part of the frame (a RegionOfInterest), None for the full frame
+ROI = None
+
+# How blobs are extracted from the foreground mask, see DETECTORS
+DETECTOR = "contours"
+
+# How the tracker assigns the blobs of a frame to the vehicles, see vehicle_counter.ASSIGNERS
+TRACKER = ASSIGN_FIRST
+
+# How the background is modelled, see background.BACKGROUND_MODELS
+BG_MODEL = "mog"
+
+# How much of the background model every analysed frame replaces
+BG_LEARNING_RATE = 0.01
+
+# Keep a background image per camera in this directory to warm start the model, None to disable
+BG_CACHE_DIR = "cache"
+
+# A cached background older than this (seconds), or this much darker or brighter, is not used
+BG_CACHE_MAX_AGE = 6 * 3600
+BG_CACHE_MAX_BRIGHTNESS = 20.0
+
+# How often the cached background is saved while counting, in seconds
+BG_CACHE_SAVE_INTERVAL = 60
+
+# Skip the background model and the vehicle search while nothing moves and nothing is tracked
+MOTION_GATE_MODE = False
+
+# While the motion gate skips frames, every this many frames still train the background model
+GATE_FEED_EVERY = 10
+
+# The MotionGate of the running session
+MOTION_GATE = None
+
+# The BackgroundCache of the running session
+BG_CACHE = None
+
+# Keep the frame number of every counted vehicle, to score the counts against ground truth
+RECORD_COUNTS = False
+
+# The frame numbers of the vehicles counted in the last session, when RECORD_COUNTS is set
+COUNTED_FRAMES = None
+
+# The RollingReporter of the running session
+REPORTER = None
 # ============================================================================
 
 def parse_args():
     log = logging.getLogger("parse_args")
     global LOG_TO_FILE, IMAGE_SOURCE, CAPTURE_FROM_VIDEO, SAVE_TO_FRAME, WAIT_TIME, TIME_INTERVAL, CAPTURE_FROM_STREAMING, CAPTURE_FROM_PICTURE
+    global PIPELINE_MODE, PIPELINE_QUEUE_SIZE, PIPELINE_POLICY, HEADLESS, SAMPLE_STRIDE, SAMPLE_PERIOD_MS, ROI
+    global REALTIME_MODE, DEADLINE_MS
+    global DETECTOR, TRACKER, BG_MODEL, LOG_LEVEL, TRACE_FILE, TRACE_ON_START, TRACE_FRACTION
+    global FRAME_FORMAT, FRAME_QUALITY, FRAME_QUEUE_SIZE, FRAME_WRITERS, FRAME_DROP_POLICY, FRAME_SAMPLE_EVERY
+    global FRAME_ARCHIVE, FRAME_ARCHIVE_SEGMENT
+    global BG_CACHE_DIR, BG_CACHE_MAX_AGE, BG_CACHE_MAX_BRIGHTNESS, BG_CACHE_SAVE_INTERVAL
+    global OUTBOX_FILE, IMAGE_SOURCES, CAMERA_WORKERS, MOTION_GATE_MODE, GATE_FEED_EVERY
 
     # construct the argument parser and parse the arguments
     ap = argparse.ArgumentParser(prog='PROG',description="Vehicle Counting based on RaspberryPi 3.0 B+")
@@ -220,10 +410,48 @@ def parse_args():
     group.add_argument("-v","--video", help="The path to the video file")
     group.add_argument("-s","--streaming",help="The index of camera that you want to use")
     group.add_argument("-p","--picture", help = "The path to the picture files")
+    group.add_argument("-c","--cameras", nargs="+", help = "Count several camera indexes, streams or video files at once")
 
     ap.add_argument("-l","--logFile", help = "Save log into a local file",action="store_true")
     ap.add_argument("-f","--frameSave", help = "Save the intermediate frames",action="store_true")
-    ap.add_argument("-i", "--interval", help="The time interval to take a frame from video")
+    ap.add_argument("--frameFormat", choices=["png", "jpg"], help = "The image format of the saved frames")
+    ap.add_argument("--frameQuality", type=int, help = "PNG compression level (0-9) or JPEG quality (0-100)")
+    ap.add_argument("--frameQueue", type=int, help = "The number of frames waiting to be written")
+    ap.add_argument("--frameWriters", type=int, help = "The number of threads writing frames")
+    ap.add_argument("--frameDropPolicy", choices=WRITER_POLICIES, help = "What to drop when the writers fall behind")
+    ap.add_argument("--frameSampleEvery", type=int, help = "Keep every Nth frame under the sample policy")
+    ap.add_argument("--frameArchive", help = "Append the saved frames to an archive in this directory")
+    ap.add_argument("--frameArchiveSegment", type=int, help = "The number of frames per archive segment")
+    ap.add_argument("-i", "--interval", help="The seconds between two count reports while counting")
+    ap.add_argument("--pipeline", help = "Run capture, analysis and output on separate threads",action="store_true")
+    ap.add_argument("--queueSize", type=int, help = "The number of frames queued in front of each pipeline stage")
+    ap.add_argument("--dropPolicy", choices=POLICIES, help = "What the pipeline does when the output stage falls behind")
+    ap.add_argument("--headless", help = "Count without showing any window",action="store_true")
+    ap.add_argument("--realtime", help = "Analyse the newest frame only, shedding work to meet the deadline",action="store_true")
+    ap.add_argument("--deadlineMs", type=int, help = "The deadline of a frame in real-time mode, one frame period by default")
+    ap.add_argument("--cameraWorkers", type=int, help = "The number of threads analysing the frames of the cameras")
+    ap.add_argument("--motionGate", help = "Skip the analysis of frames without motion while no vehicle is tracked",action="store_true")
+    ap.add_argument("--gateFeedEvery", type=int, help = "Train the background model on every Nth frame the motion gate skips")
+
+    sampling = ap.add_mutually_exclusive_group()
+    sampling.add_argument("--sampleEvery", type=int, help = "Analyse only every Nth frame")
+    sampling.add_argument("--sampleMs", type=int, help = "Analyse one frame per this many milliseconds")
+
+    ap.add_argument("--roi", type=parse_rect, help = "Only analyse this rectangle of the frame, as x,y,w,h")
+    ap.add_argument("--roiPolygon", type=parse_polygon, help = "Only analyse inside this polygon, as x1,y1;x2,y2;x3,y3;...")
+    ap.add_argument("--detector", choices=sorted(DETECTORS), help = "How vehicles are extracted from the foreground mask")
+    ap.add_argument("--tracker", choices=ASSIGNERS, help = "How the blobs of a frame are assigned to the tracked vehicles")
+    ap.add_argument("--bgModel", choices=sorted(BACKGROUND_MODELS), help = "How the background is modelled")
+    ap.add_argument("--bgCache", help = "The directory of the cached backgrounds")
+    ap.add_argument("--noBgCache", help = "Do not warm start from or save a cached background",action="store_true")
+    ap.add_argument("--bgCacheMaxAge", type=int, help = "Ignore cached backgrounds older than this many seconds")
+    ap.add_argument("--bgCacheMaxBrightness", type=float, help = "Ignore cached backgrounds whose brightness changed more than this")
+    ap.add_argument("--bgCacheSaveInterval", type=int, help = "Save the cached background every this many seconds")
+    ap.add_argument("--outbox", help = "The SQLite file keeping the shadow updates until they are acknowledged")
+    ap.add_argument("--noOutbox", help = "Publish the shadow updates directly, they are lost while offline",action="store_true")
+    ap.add_argument("--logLevel", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help = "The level of the log output")
+    ap.add_argument("--trace", help = "Trace contours and vehicles into this JSONL file from the start")
+    ap.add_argument("--traceFraction", type=float, help = "The fraction of frames that are traced")
 
     args = vars(ap.parse_args())
 
@@ -240,6 +468,12 @@ def parse_args():
         IMAGE_SOURCE = args["picture"]
         CAPTURE_FROM_PICTURE = True
 
+    if args.get("cameras",None) is not None:
+        IMAGE_SOURCES = [int(source) if source.isdigit() else source for source in args["cameras"]]
+
+    if args.get("cameraWorkers",None) is not None:
+        CAMERA_WORKERS = args["cameraWorkers"]
+
     if args.get("interval",None) is not None:
         TIME_INTERVAL = int(args["interval"])
 
@@ -249,6 +483,108 @@ def parse_args():
     if args.get("frameSave", False):
         SAVE_TO_FRAME = True
 
+    if args.get("frameFormat", None) is not None:
+        FRAME_FORMAT = args["frameFormat"]
+
+    if args.get("frameQuality", None) is not None:
+        FRAME_QUALITY = args["frameQuality"]
+
+    if args.get("frameQueue", None) is not None:
+        FRAME_QUEUE_SIZE = args["frameQueue"]
+
+    if args.get("frameWriters", None) is not None:
+        FRAME_WRITERS = args["frameWriters"]
+
+    if args.get("frameDropPolicy", None) is not None:
+        FRAME_DROP_POLICY = args["frameDropPolicy"]
+
+    if args.get("frameSampleEvery", None) is not None:
+        FRAME_SAMPLE_EVERY = args["frameSampleEvery"]
+
+    if args.get("frameArchive", None) is not None:
+        FRAME_ARCHIVE = args["frameArchive"]
+
+    if args.get("frameArchiveSegment", None) is not None:
+        FRAME_ARCHIVE_SEGMENT = args["frameArchiveSegment"]
+
+    if args.get("pipeline", False):
+        PIPELINE_MODE = True
+
+    if args.get("queueSize", None) is not None:
+        PIPELINE_QUEUE_SIZE = args["queueSize"]
+
+    if args.get("dropPolicy", None) is not None:
+        PIPELINE_POLICY = args["dropPolicy"]
+
+    if args.get("headless", False):
+        HEADLESS = True
+
+    if args.get("realtime", False):
+        REALTIME_MODE = True
+
+    if args.get("deadlineMs", None) is not None:
+        DEADLINE_MS = args["deadlineMs"]
+
+    if args.get("motionGate", False):
+        MOTION_GATE_MODE = True
+
+    if args.get("gateFeedEvery", None) is not None:
+        GATE_FEED_EVERY = args["gateFeedEvery"]
+
+    if args.get("sampleEvery", None) is not None:
+        SAMPLE_STRIDE = max(1, args["sampleEvery"])
+
+    if args.get("sampleMs", None) is not None:
+        SAMPLE_PERIOD_MS = args["sampleMs"]
+
+    if args.get("roi", None) is not None or args.get("roiPolygon", None) is not None:
+        ROI = RegionOfInterest(args.get("roi", None), args.get("roiPolygon", None))
+
+    if args.get("detector", None) is not None:
+        if args["detector"] == "components" and not hasattr(cv2, "connectedComponentsWithStats"):
+            ap.error("The components detector needs OpenCV 3.0 or later")
+        DETECTOR = args["detector"]
+
+    if args.get("tracker", None) is not None:
+        TRACKER = args["tracker"]
+
+    if args.get("bgModel", None) is not None:
+        BG_MODEL = args["bgModel"]
+
+    if args.get("bgCache", None) is not None:
+        BG_CACHE_DIR = args["bgCache"]
+
+    if args.get("noBgCache", False):
+        BG_CACHE_DIR = None
+
+    if args.get("bgCacheMaxAge", None) is not None:
+        BG_CACHE_MAX_AGE = args["bgCacheMaxAge"]
+
+    if args.get("bgCacheMaxBrightness", None) is not None:
+        BG_CACHE_MAX_BRIGHTNESS = args["bgCacheMaxBrightness"]
+
+    if args.get("bgCacheSaveInterval", None) is not None:
+        BG_CACHE_SAVE_INTERVAL = args["bgCacheSaveInterval"]
+
+    if args.get("outbox", None) is not None:
+        OUTBOX_FILE = args["outbox"]
+
+    if args.get("noOutbox", False):
+        OUTBOX_FILE = None
+
+    if args.get("logLevel", None) is not None:
+        LOG_LEVEL = args["logLevel"]
+
+    if args.get("trace", None) is not None:
+        # The tracer keeps the frame number of a single source, see multi_camera
+        if IMAGE_SOURCES:
+            ap.error("Tracing only applies to a single source, not to --cameras")
+        TRACE_FILE = args["trace"]
+        TRACE_ON_START = True
+
+    if args.get("traceFraction", None) is not None:
+        TRACE_FRACTION = args["traceFraction"]
+
     return ap
 
 
@@ -270,7 +606,7 @@ def init_logging():
         handler_file.setFormatter(formatter)
         main_logger.addHandler(handler_file)
 
-    main_logger.setLevel(logging.DEBUG)
+    main_logger.setLevel(getattr(logging, LOG_LEVEL))
 
     return main_logger
 
@@ -281,8 +617,31 @@ def save_frame(file_name_format, frame_number, frame, label_format):
     if SAVE_TO_FRAME:
         file_name = file_name_format % frame_number
         label = label_format % frame_number
-        log.debug("Saving %s as '%s'", label, file_name)
-        cv2.imwrite(file_name, frame)
+        if FRAME_WRITER is not None:
+            # Encoding and writing happen on the writer threads
+            log.debug("Queueing %s as '%s'", label, FRAME_WRITER.file_name(file_name))
+            FRAME_WRITER.submit(file_name, frame_number, frame)
+        else:
+            log.debug("Saving %s as '%s'", label, file_name)
+            cv2.imwrite(file_name, frame)
+
+def create_frame_writer(fps):
+    """The background writer of the intermediate frames, and the archive it writes to if any."""
+    if FRAME_ARCHIVE is None:
+        return FrameWriter(FRAME_FORMAT, FRAME_QUALITY, FRAME_QUEUE_SIZE, FRAME_WRITERS
+            , FRAME_DROP_POLICY, FRAME_SAMPLE_EVERY), None
+
+    archive = ArchiveWriter(FRAME_ARCHIVE, fps, FRAME_ARCHIVE_SEGMENT)
+
+    def archive_sink(file_name, frame_number, frame):
+        # The kind is the prefix of the file name format: frame, mask or processed
+        kind = os.path.basename(file_name).split("_")[0]
+        return archive.append(kind, frame_number, frame)
+
+    # A single writer keeps the frames of every segment in order
+    writer = FrameWriter(FRAME_FORMAT, FRAME_QUALITY, FRAME_QUEUE_SIZE, 1
+        , FRAME_DROP_POLICY, FRAME_SAMPLE_EVERY, sink = archive_sink)
+    return writer, archive
 
 # ============================================================================
 # Get the central point of a car
@@ -297,11 +656,11 @@ def get_centroid(x, y, w, h):
 
 # ============================================================================
 
-def detect_vehicles(fg_mask):
-    log = logging.getLogger("detect_vehicles")
+MIN_CONTOUR_WIDTH = 15
+MIN_CONTOUR_HEIGHT = 15
 
-    MIN_CONTOUR_WIDTH = 15
-    MIN_CONTOUR_HEIGHT = 15
+def detect_vehicles(fg_mask, context=None):
+    log = context.detect_log if context is not None else logging.getLogger("detect_vehicles")
 
     # Find the contours of any object in  the image , but not all vehicles
     contours, hierarchy = cv2.findContours(fg_mask
@@ -317,8 +676,8 @@ def detect_vehicles(fg_mask):
         (x, y, w, h) = cv2.boundingRect(contour)
         contour_valid = (w >= MIN_CONTOUR_WIDTH) and (h >= MIN_CONTOUR_HEIGHT)
 
-        log.debug("Contour #%d: pos=(x=%d, y=%d) size=(w=%d, h=%d) valid=%s"
-            , i, x, y, w, h, contour_valid)
+        if TRACER.active:
+            TRACER.contour(i, (x, y, w, h), contour_valid)
 
         if not contour_valid:
             continue
@@ -329,143 +688,716 @@ def detect_vehicles(fg_mask):
 
     return matches
 
+
+def detect_vehicles_components(fg_mask, context=None):
+    """Same as detect_vehicles, from connected component statistics.
+
+    Boxes of all the blobs come back from OpenCV as one NumPy array, so the
+    size filtering and the centroids are array operations instead of a
+    Python loop over every contour.
+    """
+    log = context.detect_log if context is not None else logging.getLogger("detect_vehicles")
+
+    labels = context.labels_buffer(fg_mask) if context is not None else None
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(fg_mask, labels, connectivity = 8)
+
+    # Label 0 is the background
+    boxes = stats[1:, :4]
+    log.debug("Found %d vehicle blobs.", count - 1)
+
+    valid = (boxes[:, 2] >= MIN_CONTOUR_WIDTH) & (boxes[:, 3] >= MIN_CONTOUR_HEIGHT)
+    if TRACER.active:
+        for i, (box, box_valid) in enumerate(zip(boxes.tolist(), valid.tolist())):
+            TRACER.contour(i, box, box_valid)
+
+    boxes = boxes[valid]
+
+    # The centre of the bounding box, as get_centroid does
+    centroids = boxes[:, :2] + boxes[:, 2:4] // 2
+
+    return [(tuple(box), tuple(centroid))
+        for (box, centroid) in zip(boxes.tolist(), centroids.tolist())]
+
+
+DETECTORS = {
+    "contours": detect_vehicles,
+    "components": detect_vehicles_components,
+}
+
 # ============================================================================
 
-def filter_mask(fg_mask):
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+def filter_mask(fg_mask, context=None):
+    if context is None:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        closing = opening = dilation = None
+    else:
+        # Write into the buffers of the previous frame instead of allocating new ones
+        kernel = context.kernel
+        closing, opening, dilation = context.morphology_buffers(fg_mask)
 
     # Fill any small holes
-    closing = cv2.morphologyEx(fg_mask, cv2.MORPH_CLOSE, kernel)
+    closing = cv2.morphologyEx(fg_mask, cv2.MORPH_CLOSE, kernel, dst = closing)
     # Remove noise
-    opening = cv2.morphologyEx(closing, cv2.MORPH_OPEN, kernel)
+    opening = cv2.morphologyEx(closing, cv2.MORPH_OPEN, kernel, dst = opening)
 
     # Dilate to merge adjacent blobs
-    dilation = cv2.dilate(opening, kernel, iterations = 2)
+    dilation = cv2.dilate(opening, kernel, dst = dilation, iterations = 2)
 
     return dilation
 
 # ============================================================================
 
-def process_frame(frame_number, frame, bg_subtractor, car_counter):
-    log = logging.getLogger("process_frame")
+class FrameContext(object):
+    """What process_frame keeps from one frame to the next.
+
+    Owns the morphology kernel, the loggers and preallocated buffers that the
+    OpenCV calls write into (dst=), so once the first frame is processed the
+    loop allocates next to nothing. Buffers are reallocated only when the
+    frame size changes.
+
+    The annotated frames come from a ring of `output_buffers` buffers. The
+    threaded pipeline needs one per frame that can be in flight after the
+    analysis stage, the sequential loop needs only one.
+
+    With several cameras, `camera` is the Camera the frames come from, whose
+    ROI, background cache, motion gate, reporter and metrics are used instead
+    of the module-level ones.
+    """
+    def __init__(self, output_buffers=1):
+        self.process_log = logging.getLogger("process_frame")
+        self.detect_log = logging.getLogger("detect_vehicles")
+        self.camera = None  # set by create_camera
+
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+
+        self.mask_shape = None
+        self.fg_mask = None
+        self.closing = None
+        self.opening = None
+        self.dilation = None
+        self.labels = None
+
+        self.output_buffers = max(1, output_buffers)
+        self.output_shape = None
+        self.outputs = []
+        self.next_output = 0
+
+    def _ensure_mask_buffers(self, shape):
+        shape = tuple(shape[:2])
+        if shape != self.mask_shape:
+            self.mask_shape = shape
+            self.fg_mask = np.zeros(shape, np.uint8)
+            self.closing = np.zeros(shape, np.uint8)
+            self.opening = np.zeros(shape, np.uint8)
+            self.dilation = np.zeros(shape, np.uint8)
+            self.labels = np.zeros(shape, np.int32)
+
+    def mask_buffer(self, region):
+        """The buffer the background subtractor writes the foreground mask of `region` into."""
+        self._ensure_mask_buffers(region.shape)
+        return self.fg_mask
+
+    def morphology_buffers(self, fg_mask):
+        self._ensure_mask_buffers(fg_mask.shape)
+        return self.closing, self.opening, self.dilation
+
+    def labels_buffer(self, fg_mask):
+        self._ensure_mask_buffers(fg_mask.shape)
+        return self.labels
+
+    def copy_frame(self, frame):
+        """Copy the frame into the next annotation buffer of the ring."""
+        if frame.shape != self.output_shape:
+            self.output_shape = frame.shape
+            self.outputs = [np.empty_like(frame) for _ in range(self.output_buffers)]
+            self.next_output = 0
+
+        processed = self.outputs[self.next_output]
+        self.next_output = (self.next_output + 1) % len(self.outputs)
+        processed[...] = frame
+        return processed
+
+# ============================================================================
+
+def annotation_needed():
+    """The annotated frame is only worth building if something will use it."""
+    return (not HEADLESS) or SAVE_TO_FRAME
 
-    # Create a copy of source frame to draw into
-    processed = frame.copy()
+# ============================================================================
+
+def process_frame(frame_number, frame, bg_subtractor, car_counter, context=None, annotate=None):
+    if context is None:
+        context = FrameContext()
+    if annotate is None:
+        annotate = annotation_needed()
+    log = context.process_log
+    TRACER.begin_frame(frame_number)
+
+    camera = context.camera
+    if camera is None:
+        roi, bg_cache, motion_gate, reporter, metrics = ROI, BG_CACHE, MOTION_GATE, REPORTER, METRICS
+    else:
+        roi, bg_cache, motion_gate = camera.roi, camera.bg_cache, camera.motion_gate
+        reporter, metrics = camera.reporter, camera.metrics
+
+    # Create a copy of source frame to draw into, None when nobody looks at it
+    t = clock()
+    processed = context.copy_frame(frame) if annotate else None
+    t = metrics.record("copy", t)
 
     # Draw dividing line -- we count cars as they cross this line.
     #cv2.line(processed, (0, car_counter.divider), (frame.shape[1], car_counter.divider), DIVIDER_COLOUR, 1)
 
-    # Remove the background
-    fg_mask = bg_subtractor.apply(frame, None, 0.01)
-    fg_mask = filter_mask(fg_mask)
+    # Only the region of interest goes through background removal and contour search
+    region = frame if roi is None else roi.crop(frame)
+
+    # Warm start the model on the first frame, then keep the cached background up to date
+    if bg_cache is not None:
+        bg_cache.observe(region, bg_subtractor)
+    t = metrics.record("bg_cache", t)
+
+    # While the scene is static and nothing is tracked, there is nothing to count,
+    # only feed the background model now and then so it does not go stale
+    if motion_gate is not None:
+        moving = motion_gate.check(region)
+        t = metrics.record("gate", t)
+        if not moving and not car_counter.vehicles:
+            if motion_gate.feed_due():
+                bg_subtractor.apply(region, context.mask_buffer(region), motion_gate.learning_rate(BG_LEARNING_RATE))
+                motion_gate.record_feed(t)
+            if reporter is not None:
+                reporter.update(frame_number, car_counter.vehicle_count)
+            return processed
+    gate_end = t
 
-    save_frame(IMAGE_DIR + "/mask_%04d.png"
-        , frame_number, fg_mask, "foreground mask for frame #%d")
-
-    matches = detect_vehicles(fg_mask)
+    # Remove the background
+    fg_mask = bg_subtractor.apply(region, context.mask_buffer(region), BG_LEARNING_RATE)
+    t = metrics.record("apply", t)
+    fg_mask = filter_mask(fg_mask, context)
+    if roi is not None:
+        roi.apply_mask(fg_mask)
+    t = metrics.record("filter", t)
+
+    # The file names have no camera in them, so only a single source saves its masks
+    if camera is None:
+        save_frame(IMAGE_DIR + "/mask_%04d.png"
+            , frame_number, fg_mask, "foreground mask for frame #%d")
+
+    t = clock()
+    matches = DETECTORS[DETECTOR](fg_mask, context)
+    if roi is not None:
+        # Back to full frame coordinates for drawing and tracking
+        matches = roi.to_frame(matches)
+    t = metrics.record("detect", t)
+    if roi is not None:
+        if processed is not None:
+            roi.draw(processed, ROI_COLOUR)
 
     log.debug("Found %d valid vehicle contours.", len(matches))
     for (i, match) in enumerate(matches):
-        contour, centroid = match
-
-        log.debug("Valid vehicle contour #%d: centroid=%s, bounding_box=%s", i, centroid, contour)
+        if processed is None:
+            break
 
+        contour, centroid = match
         x, y, w, h = contour
 
         # Mark the bounding box and the centroid on the processed frame
         # NB: Fixed the off-by one in the bottom right corner
         cv2.rectangle(processed, (x, y), (x + w - 1, y + h - 1), BOUNDING_BOX_COLOUR, 1)
         cv2.circle(processed, centroid, 2, CENTROID_COLOUR, -1)
+    t = metrics.record("draw", t)
 
     log.debug("Updating vehicle count...")
-    car_counter.update_count(matches, processed)
+    car_counter.update_count(matches, processed, frame_number)
+    if reporter is not None:
+        reporter.update(frame_number, car_counter.vehicle_count)
+    metrics.record("update_count", t)
+    if motion_gate is not None:
+        motion_gate.record_full(gate_end)
 
     return processed
 
 # ============================================================================
 
-def main():
+def show_frame(frame, processed):
+    """Show the source and processed frames, returns the key pressed if any.
+
+    In headless mode there is no window, so the GUI event pump and its
+    WAIT_TIME delay per frame are skipped altogether.
+    """
+    if HEADLESS:
+        return -1
+
+    cv2.imshow('Source Image', frame)
+    if processed is not None:
+        cv2.imshow('Processed Image', processed)
+
+    return cv2.waitKey(WAIT_TIME)
+
+# ============================================================================
+
+def sampling_stride(fps):
+    """The number of source frames between two analysed frames."""
+    log = logging.getLogger("sampling_stride")
+
+    if SAMPLE_PERIOD_MS is None:
+        return max(1, SAMPLE_STRIDE)
+
+    if not fps or fps <= 0:
+        log.warning("Unknown frame rate, analysing every frame instead of every %d ms.", SAMPLE_PERIOD_MS)
+        return 1
+
+    return max(1, int(round(fps * SAMPLE_PERIOD_MS / 1000.0)))
+
+
+def read_frame(cap, stride=1, image=None):
+    """Read the next frame to analyse, skipping the stride - 1 frames in front of it.
+
+    The skipped frames are only grabbed and never retrieved, so they are
+    never decoded into an image. When given, the frame is decoded into `image`.
+    Returns (ret, frame, skipped) where skipped is the number of frames grabbed.
+    """
+    skipped = 0
+    while skipped < stride - 1:
+        if not cap.grab():
+            return False, None, skipped
+        skipped += 1
+
+    if image is not None:
+        ret, frame = cap.read(image)
+    else:
+        ret, frame = cap.read()
+    return ret, frame, skipped
+
+# ============================================================================
+
+def create_bg_subtractor():
+    log = logging.getLogger("create_bg_subtractor")
+
+    log.debug("Creating background subtractor '%s'...", BG_MODEL)
+    return create_background_model(BG_MODEL)
+
+
+def create_vehicle_counter(frame, stride=1):
+    # We do this after the first frame, so that we can initialize with actual frame size
+    car_counter = VehicleCounter(frame.shape[:2], frame.shape[0] / 2, stride, TRACKER)
+    if RECORD_COUNTS:
+        car_counter.counted_frames = []
+    return car_counter
+
+
+def create_motion_gate():
+    if not MOTION_GATE_MODE:
+        return None
+    return MotionGate(feed_every = GATE_FEED_EVERY)
+
+
+def report_motion_gate(motion_gate, metrics):
+    """Log how much the motion gate skipped, and add it to the counters of the session."""
+    log = logging.getLogger("report_motion_gate")
+    summary = motion_gate.summary()
+    log.info("Motion gate: %(skipped)d of %(checked)d frames skipped (hit rate %(hit_rate).1f%%)"
+        ", %(fed)d fed to the model, %(check_ms).3f ms per check, about %(saved_ms)d ms saved."
+        , dict(summary, hit_rate = 100.0 * summary["hit_rate"]))
+    for key in ("checked", "skipped", "fed", "saved_ms"):
+        metrics.increment("gate_" + key, summary[key])
+
+
+def create_bg_cache(image_source):
+    """The BackgroundCache of a camera or video, which pre-trains the model on the first frame."""
+    if BG_CACHE_DIR is None:
+        return None
+    return BackgroundCache(cache_path(BG_CACHE_DIR, image_source), BG_CACHE_MAX_AGE
+        , BG_CACHE_MAX_BRIGHTNESS, BG_CACHE_SAVE_INTERVAL)
+
+# ============================================================================
+
+def main(image_source=None, stop_event=None, publish_report=None):
+    """Count the vehicles of a source until it ends, ESC is pressed or stop_event is set.
+
+    When given, publish_report(report) gets the counts of the last
+    TIME_INTERVAL seconds while counting, see RollingReporter.
+    """
+    global FRAME_WRITER, BG_CACHE, COUNTED_FRAMES, REPORTER, MOTION_GATE
     start = time.time()
     log = logging.getLogger("main")
 
-    log.debug("Creating background subtractor...")
-    bg_subtractor = cv2.BackgroundSubtractorMOG()
-
-    log.debug("Pre-training the background subtractor...")
-    default_bg = cv2.imread(IMAGE_FILENAME_FORMAT % 1)
-    bg_subtractor.apply(default_bg, None, 1.0)
+    if image_source is None:
+        image_source = IMAGE_SOURCE
 
-    car_counter = None # Will be created after first frame is captured
+    METRICS.reset()
+    bg_subtractor = create_bg_subtractor()
+    BG_CACHE = create_bg_cache(image_source)
+    MOTION_GATE = create_motion_gate()
 
     # Set up image source
-    log.debug("Initializing video capture device #%s...", IMAGE_SOURCE)
-    cap = cv2.VideoCapture(IMAGE_SOURCE)
+    log.debug("Initializing video capture device #%s...", image_source)
+    cap = cv2.VideoCapture(image_source)
 
-    # Capture every TIME_INTERVAL seconds (here, TIME_INTERVAL = 5)
-    fps = cap.get(cv2.cv.CV_CAP_PROP_FPS)  # Gets the frames per second
-    #multiplier = TIME_INTERVAL
+    fps = cap.get(CV_CAP_PROP_FPS)  # Gets the frames per second
 
-    log.debug("Update car counting by every %d ...", TIME_INTERVAL)
+    archive = None
+    if SAVE_TO_FRAME:
+        FRAME_WRITER, archive = create_frame_writer(fps)
+
+    if publish_report is not None:
+        log.debug("Update car counting by every %d ...", TIME_INTERVAL)
+        REPORTER = RollingReporter(TIME_INTERVAL, fps, publish_report)
 
     # Check Camera is open or not
     if not cap.isOpened():
         log.debug("The Camera is not open ...")
-        cap.open()
+        if not cap.open(image_source):
+            log.error("Unable to open '%s', nothing to count.", image_source)
 
-    CV_CAP_PROP_FRAME_WIDTH = 3
-    CV_CAP_PROP_FRAME_HEIGHT = 4
     if CAPTURE_FROM_STREAMING:
         cap.set(CV_CAP_PROP_FRAME_WIDTH, 320);
         cap.set(CV_CAP_PROP_FRAME_HEIGHT, 320);
 
-    frame_width = cap.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH)
-    frame_height = cap.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT)
+    frame_width = cap.get(CV_CAP_PROP_FRAME_WIDTH)
+    frame_height = cap.get(CV_CAP_PROP_FRAME_HEIGHT)
     log.debug("Video capture frame size=(w=%d, h=%d)", frame_width, frame_height)
 
+    stride = sampling_stride(fps)
+    log.debug("Analysing one frame out of %d...", stride)
+
+    if REALTIME_MODE:
+        car_counter, frame_number = run_realtime(cap, bg_subtractor, fps, stop_event)
+    elif PIPELINE_MODE:
+        car_counter, frame_number = run_pipeline(cap, bg_subtractor, stride, stop_event)
+    else:
+        car_counter, frame_number = run_loop(cap, bg_subtractor, stride, stop_event)
+
+    # Without a single frame there is no counter, and maybe not even a frame rate
+    vehicle_count = car_counter.vehicle_count if car_counter is not None else 0
+    during = max(0, frame_number) / fps if fps and fps > 0 else 0.0
+    if car_counter is not None:
+        COUNTED_FRAMES = car_counter.counted_frames
+    else:
+        COUNTED_FRAMES = [] if RECORD_COUNTS else None
+    log.debug("Closing video capture device...")
+    cap.release()
+    if not HEADLESS:
+        cv2.destroyAllWindows()
+    if FRAME_WRITER is not None:
+        log.debug("Writing the remaining frames...")
+        FRAME_WRITER.close()
+        FRAME_WRITER = None
+    if archive is not None:
+        archive.close()
+    if BG_CACHE is not None:
+        BG_CACHE.close()
+        BG_CACHE = None
+    if REPORTER is not None:
+        REPORTER.close()
+        REPORTER = None
+    if MOTION_GATE is not None:
+        report_motion_gate(MOTION_GATE, METRICS)
+        MOTION_GATE = None
+    METRICS.finish()
+    METRICS.dump()
+    log.debug("Done.")
+    end = time.time()
+    return vehicle_count,during
+
+# ============================================================================
+
+def create_camera(name, source, publish_report=None):
+    """A Camera of main_cameras, with its own capture, background model and reporter."""
+    log = logging.getLogger("create_camera")
+
+    log.debug("Initializing video capture device #%s as camera '%s'...", source, name)
+    cap = cv2.VideoCapture(source)
+    fps = cap.get(CV_CAP_PROP_FPS)
+
+    reporter = None
+    if publish_report is not None:
+        # The window reports of each camera go to a key of its own
+        reporter = RollingReporter(TIME_INTERVAL, fps
+            , lambda report: publish_report({"Cameras": {name: report}}))
+
+    context = FrameContext()
+    camera = Camera(name, source, cap, create_bg_subtractor(), context
+        , bg_cache = create_bg_cache(source)
+        , motion_gate = create_motion_gate()
+        , reporter = reporter
+        , roi = RegionOfInterest(ROI.rect, ROI.polygon) if ROI is not None else None
+        , fps = fps
+        , stride = sampling_stride(fps)
+        , live = is_live(source))
+    context.camera = camera
+    return camera
+
+
+def analyse_camera(camera, frame_number, frame):
+    """Analyse one frame of a camera, called by the MultiCameraService workers."""
+    if camera.car_counter is None:
+        camera.car_counter = create_vehicle_counter(frame, camera.stride)
+    else:
+        # A live camera drops the frames the workers had no time for
+        camera.car_counter.set_frame_stride(frame_number - camera.analysed)
+    camera.analysed = frame_number
+    process_frame(frame_number, frame, camera.bg_subtractor, camera.car_counter, camera.context
+        , annotate = False)
+
+
+def main_cameras(sources, stop_event=None, publish_report=None):
+    """Count the vehicles of several sources at once, until they all end or stop_event is set.
+
+    Each source gets its own background model and counter, and a pool of
+    CAMERA_WORKERS threads analyses their frames in turn. There is no window
+    and no frame is saved. Returns {camera name: (count, seconds, metrics summary)}.
+    """
+    log = logging.getLogger("main_cameras")
+    if REALTIME_MODE or PIPELINE_MODE:
+        log.warning("The real-time and pipeline modes only apply to a single source, ignoring them.")
+
+    cameras = [create_camera(name, source, publish_report)
+        for name, source in zip(camera_names(sources), sources)]
+
+    MultiCameraService(cameras, analyse_camera, CAMERA_WORKERS, stop_event).run()
+
+    results = {}
+    for camera in cameras:
+        if camera.bg_cache is not None:
+            camera.bg_cache.close()
+        if camera.reporter is not None:
+            camera.reporter.close()
+        if camera.motion_gate is not None:
+            report_motion_gate(camera.motion_gate, camera.metrics)
+
+        count = camera.car_counter.vehicle_count if camera.car_counter is not None else 0
+        # Counted frames / fps, the same time as main() reports for a single source
+        during = (camera.frame_number + 1) / camera.fps if camera.fps else 0.0
+        log.info("Camera '%s': %d vehicles in %.1f s.", camera.name, count, during)
+        summary = camera.metrics.dump()
+        results[camera.name] = (count, during, summary)
+    return results
+
+# ============================================================================
+
+def run_loop(cap, bg_subtractor, stride=1, stop_event=None):
+    log = logging.getLogger("run_loop")
+
+    car_counter = None # Will be created after first frame is captured
+    context = FrameContext()
+
     log.debug("Starting capture loop...\n")
     frame_number = -1
+    frame = None
     while True:
-        frame_number += 1
-        log.debug("Capturing frame #%d...", frame_number)
-        ret, frame = cap.read()
+        log.debug("Capturing frame #%d...", frame_number + stride)
+        # Nothing keeps the previous frame, so decode straight into it
+        frame_start = clock()
+        ret, frame, skipped = read_frame(cap, stride, frame)
+        METRICS.record("read", frame_start)
+        frame_number += skipped + 1
         if not ret:
             log.error("Frame capture failed, stopping...")
             break
+        METRICS.frame(skipped)
 
         log.debug("Got frame #%d: shape=%s", frame_number, frame.shape)
 
         if car_counter is None:
-            # We do this here, so that we can initialize with actual frame size
             log.debug("Creating vehicle counter...")
-            car_counter = VehicleCounter(frame.shape[:2], frame.shape[0] / 2)
+            car_counter = create_vehicle_counter(frame, stride)
 
         # Archive raw frames from video to disk for later inspection/testing
-        if CAPTURE_FROM_VIDEO and CAPTURE_FROM_STREAMING:
-            save_frame(IMAGE_FILENAME_FORMAT
-                , frame_number, frame, "source frame #%d")
+        save_frame(IMAGE_FILENAME_FORMAT
+            , frame_number, frame, "source frame #%d")
 
         log.debug("Processing frame #%d...", frame_number)
-        processed = process_frame(frame_number, frame, bg_subtractor, car_counter)
+        processed = process_frame(frame_number, frame, bg_subtractor, car_counter, context)
 
+        t = clock()
         save_frame(IMAGE_DIR + "/processed_%04d.png"
             , frame_number, processed, "processed frame #%d")
 
-        cv2.imshow('Source Image', frame)
-        cv2.imshow('Processed Image', processed)
-
         log.debug("Frame #%d processed.\n", frame_number)
 
-        c = cv2.waitKey(WAIT_TIME)
+        c = show_frame(frame, processed)
+        METRICS.record("show", t)
+        METRICS.record("frame", frame_start)
         if c == 27:
             log.debug("ESC detected, stopping...")
             break
-    during = frame_number / fps
-    log.debug("Closing video capture device...")
-    cap.release()
-    cv2.destroyAllWindows()
-    log.debug("Done.")
-    end = time.time()
-    return car_counter.vehicle_count,during
+        if stop_event is not None and stop_event.is_set():
+            log.debug("Stop requested, stopping...")
+            break
+
+    return car_counter, frame_number
+
+# ============================================================================
+
+def run_pipeline(cap, bg_subtractor, stride=1, stop_event=None):
+    """Same as run_loop, but capture, analysis and output each run on their own thread.
+
+    The frame rate is then bound by the slowest stage instead of the sum of all of them.
+    """
+    log = logging.getLogger("run_pipeline")
+
+    # Shared with the stage threads, each key is written by a single stage only
+    state = {"frame_number": -1, "car_counter": None}
+
+    # Frames queued for output, plus the one shown and the one drawn, need their own buffer
+    context = FrameContext(output_buffers = PIPELINE_QUEUE_SIZE + 2)
+
+    def capture():
+        if stop_event is not None and stop_event.is_set():
+            log.debug("Stop requested, stopping...")
+            return None
+        t = clock()
+        ret, frame, skipped = read_frame(cap, stride)
+        METRICS.record("read", t)
+        state["frame_number"] += skipped
+        if not ret:
+            log.error("Frame capture failed, stopping...")
+            return None
+        state["frame_number"] += 1
+        METRICS.frame(skipped)
+        frame_number = state["frame_number"]
+        log.debug("Got frame #%d: shape=%s", frame_number, frame.shape)
+
+        # Archive raw frames from video to disk for later inspection/testing
+        save_frame(IMAGE_FILENAME_FORMAT
+            , frame_number, frame, "source frame #%d")
+        return (frame_number, frame)
+
+    def analyse(item):
+        frame_number, frame = item
+        if state["car_counter"] is None:
+            log.debug("Creating vehicle counter...")
+            state["car_counter"] = create_vehicle_counter(frame, stride)
+
+        log.debug("Processing frame #%d...", frame_number)
+        t = clock()
+        processed = process_frame(frame_number, frame, bg_subtractor, state["car_counter"], context)
+        METRICS.record("analysis", t)
+        return (frame_number, frame, processed)
+
+    def output(item):
+        frame_number, frame, processed = item
+        t = clock()
+        save_frame(IMAGE_DIR + "/processed_%04d.png"
+            , frame_number, processed, "processed frame #%d")
+
+        log.debug("Frame #%d processed.\n", frame_number)
+
+        c = show_frame(frame, processed)
+        METRICS.record("show", t)
+        if c == 27:
+            log.debug("ESC detected, stopping...")
+            pipeline.stop()
+        return None
+
+    # The tracker and the background model need every frame, so only the output drops frames
+    pipeline = FramePipeline(capture
+        , [("analysis", analyse, POLICY_BLOCK), ("output", output)]
+        , maxsize = PIPELINE_QUEUE_SIZE
+        , policy = PIPELINE_POLICY)
+
+    log.debug("Starting capture pipeline (queue size=%d, policy=%s)...\n"
+        , PIPELINE_QUEUE_SIZE, PIPELINE_POLICY)
+    pipeline.run()
+    METRICS.drop(sum(stats["dropped"] for stats in pipeline.stats().values()))
+
+    # The capture stage counts the frame that failed, as run_loop does
+    return state["car_counter"], state["frame_number"] + 1
+
+# ============================================================================
+
+def run_realtime(cap, bg_subtractor, fps, stop_event=None):
+    """Same as run_loop, but never lagging behind a live source.
+
+    A reader thread keeps only the newest frame, so frames that cannot be
+    analysed in time are dropped instead of queued. When the frames still
+    finish later than the deadline after their capture, the work per frame
+    is reduced a step at a time: no drawing, then a downscaled background
+    model, then analysing every other frame only. The tracker is told how
+    many frames really passed since the previous analysed one.
+    """
+    log = logging.getLogger("run_realtime")
+
+    if DEADLINE_MS is not None:
+        deadline = DEADLINE_MS / 1000.0
+    else:
+        deadline = 1.0 / fps if fps and fps > 0 else 0.1
+    controller = DeadlineController(deadline)
+    model = DegradableModel(bg_subtractor, DownscaledGreyModel(create_background_model(BG_MODEL)))
+
+    # A video file is read at its frame rate, as if it came from a camera
+    reader = LatestFrameReader(cap, None if CAPTURE_FROM_STREAMING else fps)
+    context = FrameContext()
+    car_counter = None
+    frame_number = -1
+    skip_this = False
+
+    log.debug("Starting real-time capture loop, deadline %.1f ms...\n", 1000.0 * deadline)
+    try:
+        while True:
+            frame_start = clock()
+            ret, frame, number, captured_at, dropped = reader.read()
+            METRICS.record("read", frame_start)
+            if not ret:
+                log.error("Frame capture failed, stopping...")
+                break
+            METRICS.drop(dropped)
+
+            # At the last level every other new frame is dropped
+            level = controller.level
+            skip_this = level >= LEVEL_SKIP_FRAMES and not skip_this
+            if skip_this:
+                METRICS.drop()
+                continue
+            METRICS.frame()
+            METRICS.increment("level_" + LEVEL_NAMES[level])
+
+            if car_counter is None:
+                log.debug("Creating vehicle counter...")
+                car_counter = create_vehicle_counter(frame)
+            else:
+                car_counter.set_frame_stride(number - frame_number)
+            frame_number = number
+
+            # Archive raw frames from video to disk for later inspection/testing
+            save_frame(IMAGE_FILENAME_FORMAT
+                , frame_number, frame, "source frame #%d")
+
+            model.set_downscaled(level >= LEVEL_DOWNSCALE)
+            processed = process_frame(frame_number, frame, model, car_counter, context
+                , annotate = level < LEVEL_NO_DRAWING and annotation_needed())
+
+            t = clock()
+            if processed is not None:
+                save_frame(IMAGE_DIR + "/processed_%04d.png"
+                    , frame_number, processed, "processed frame #%d")
+            c = show_frame(frame, processed)
+            METRICS.record("show", t)
+            METRICS.record("frame", frame_start)
+
+            controller.update(time.time() - captured_at)
+            if c == 27:
+                log.debug("ESC detected, stopping...")
+                break
+            if stop_event is not None and stop_event.is_set():
+                log.debug("Stop requested, stopping...")
+                break
+    finally:
+        reader.stop()
+
+    log.info("Frames per degradation level: %s", controller.usage_counts())
+    return car_counter, frame_number + 1
+
+# ============================================================================
+
+# The counting sessions started and stopped through the shadow
+def run_session(stop_event):
+    if IMAGE_SOURCES:
+        return main_cameras(IMAGE_SOURCES, stop_event = stop_event, publish_report = Report_Window)
+    return main(stop_event = stop_event, publish_report = Report_Window)
+
+SESSIONS = SessionManager(run_session, Report_Session)
 
 # ============================================================================
 
@@ -477,7 +1409,16 @@ if __name__ == "__main__":
     # Initial log engine
     log = init_logging()
 
-    if IMAGE_SOURCE is None:
+    # Tracing can be switched on and off while counting with `kill -USR1 <pid>`
+    if TRACE_ON_START:
+        TRACER.enable(TRACE_FILE, TRACE_FRACTION)
+    if hasattr(signal, "SIGUSR1") and not IMAGE_SOURCES:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: TRACER.request_toggle(TRACE_FILE, TRACE_FRACTION))
+    # And the latency histograms so far are logged with `kill -USR2 <pid>`
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: METRICS.dump())
+
+    if IMAGE_SOURCE is None and not IMAGE_SOURCES:
         log.error("Please refer to the following help info...")
         ap.print_help()
         sys.exit(0)
@@ -487,5 +1428,16 @@ if __name__ == "__main__":
         os.makedirs(IMAGE_DIR)
 
     initial_mqttclient()
-    mqttc.loop_forever()
+    # The network loop runs on its own thread, so the callbacks return at once and
+    # the counting (and its windows) runs on the main thread
+    mqttc.loop_start()
+    try:
+        SESSIONS.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Interrupted, stopping...")
+    finally:
+        publisher.close()
+        if outbox is not None:
+            outbox.close()
+        mqttc.loop_stop()
     #main()
\ No newline at end of file
@@ -0,0 +1,168 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Per-stage latency histograms and throughput counters for the counting loop
+# ------------------------------------------
+import logging
+import math
+import threading
+import time
+
+# ============================================================================
+
+# The most precise clock there is, time.perf_counter only exists from Python 3.3
+clock = getattr(time, "perf_counter", time.time)
+
+# Bucket i holds the latencies in [MIN_LATENCY * GROWTH^i, MIN_LATENCY * GROWTH^(i+1)),
+# so the percentiles are within 10% for anything between 1 us and 100 s
+MIN_LATENCY = 1e-6
+GROWTH = 1.1
+BUCKETS = int(math.ceil(math.log(1e8) / math.log(GROWTH))) + 1
+
+_LOG_GROWTH = math.log(GROWTH)
+
+# ============================================================================
+
+class LatencyHistogram(object):
+    """A fixed size histogram of latencies in seconds, with logarithmic buckets."""
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds > MIN_LATENCY:
+            i = min(BUCKETS - 1, int(math.log(seconds / MIN_LATENCY) / _LOG_GROWTH))
+        else:
+            i = 0
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """The latency below which p percent of the recorded latencies are, in seconds."""
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                # The middle of the bucket, never more than the largest latency seen
+                return min(self.max, MIN_LATENCY * GROWTH ** (i + 0.5))
+        return self.max
+
+    def summary(self):
+        """p50/p95/p99/mean/max in milliseconds, and the number of samples."""
+        return {"n": self.count
+            , "p50": round(1000.0 * self.percentile(50), 3)
+            , "p95": round(1000.0 * self.percentile(95), 3)
+            , "p99": round(1000.0 * self.percentile(99), 3)
+            , "mean": round(1000.0 * self.total / self.count, 3) if self.count else 0.0
+            , "max": round(1000.0 * self.max, 3)}
+
+# ============================================================================
+
+class Metrics(object):
+    """Latencies per stage and frame counters of one counting session.
+
+    A stage is timed by passing the clock() reading of its start:
+
+        t = clock()
+        ...
+        t = METRICS.record("apply", t)
+
+    record() returns the clock() reading of the end, so consecutive stages
+    can be chained. Each stage must only be recorded from one thread.
+    """
+    def __init__(self):
+        self.log = logging.getLogger("metrics")
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.order = []
+            self.frames = 0
+            self.skipped = 0
+            self.dropped = 0
+            self.counters = {}
+            self.started = time.time()
+            self.finished = None
+
+    def _histogram(self, stage):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                self.stages[stage] = histogram
+                self.order.append(stage)
+            return histogram
+
+    def record(self, stage, start):
+        now = clock()
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self._histogram(stage)
+        histogram.record(now - start)
+        return now
+
+    def frame(self, skipped=0):
+        """Count an analysed frame, and the source frames skipped in front of it.
+
+        Only called from the thread that reads the frames.
+        """
+        self.frames += 1
+        self.skipped += skipped
+
+    def drop(self, count=1):
+        """Count frames that were read but never made it through the pipeline."""
+        with self.lock:
+            self.dropped += count
+
+    def increment(self, counter, count=1):
+        """Count an event of the session, like the frames handled at some setting."""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + count
+
+    def finish(self):
+        self.finished = time.time()
+
+    def summary(self):
+        wall_time = (self.finished or time.time()) - self.started
+        with self.lock:
+            stages = [(stage, self.stages[stage].summary()) for stage in self.order]
+            counters = dict(self.counters)
+        return {"frames": self.frames
+            , "skipped": self.skipped
+            , "dropped": self.dropped
+            , "wall_time": round(wall_time, 3)
+            , "fps": round(self.frames / wall_time, 2) if wall_time > 0 else 0.0
+            , "stages": dict(stages)
+            , "counters": counters}
+
+    def dump(self):
+        """Log the summary, one line per stage."""
+        summary = self.summary()
+        self.log.info("%(frames)d frames in %(wall_time).1f s = %(fps).1f fps"
+            ", %(skipped)d skipped, %(dropped)d dropped", summary)
+        with self.lock:
+            order = list(self.order)
+        for stage in order:
+            s = summary["stages"][stage]
+            self.log.info("  %-12s n=%6d p50=%8.3f p95=%8.3f p99=%8.3f max=%8.3f ms"
+                , stage, s["n"], s["p50"], s["p95"], s["p99"], s["max"])
+        for counter, count in sorted(summary["counters"].items()):
+            self.log.info("  %-12s %d", counter, count)
+        return summary
+
+# ============================================================================
+
+# The metrics of the running counting session
+METRICS = Metrics()
+
+# ============================================================================
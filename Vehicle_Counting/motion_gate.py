@@ -0,0 +1,119 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Cheap motion check that lets the counting skip frames of a static scene
+# ------------------------------------------
+import cv2
+import numpy as np
+
+from metrics import clock
+
+# ============================================================================
+
+class MotionGate(object):
+    """Tells whether anything differs from the static scene, on a tiny grey copy.
+
+    The frame is shrunk to `width` pixels wide before anything else, made
+    grey and blurred, and compared by absolute difference with a reference,
+    as Motion_Detection/motion_detector.py does. The reference is a running
+    average of these copies (`rate`), rather than the previous frame: far
+    away vehicles move less than a pixel per frame at that size, but still
+    differ from the empty road. Motion is when more than `min_changed` of
+    the pixels differ by more than `threshold`. At 64 pixels wide that is a
+    few thousand pixels per frame, next to nothing compared with the
+    background model.
+
+    While the gate is closed, every `feed_every`-th frame should still train
+    the background model (see feed_due), so it keeps up with the light.
+
+    It also keeps what is needed to report how often the frames were skipped,
+    and an estimate of the time that saved: the skipped frames times the mean
+    time of a frame that went the full way, less the time of the checks and
+    of feeding the model.
+    """
+    def __init__(self, width=64, threshold=8, min_changed=0.0002, blur=3, rate=0.05, feed_every=10):
+        self.width = width
+        self.threshold = threshold
+        self.min_changed = min_changed
+        self.blur = blur
+        self.rate = rate
+        self.feed_every = max(1, feed_every)
+
+        self.small = None
+        self.background = None
+        self.reference = None
+        self.delta = None
+        self.changed = None
+        self.since_feed = 0
+
+        self.checked = 0
+        self.skipped = 0
+        self.fed = 0
+        self.check_time = 0.0
+        self.feed_time = 0.0
+        self.full_frames = 0
+        self.full_time = 0.0
+
+    def check(self, frame):
+        """True if the frame differs from the static scene, always for the first frame."""
+        start = clock()
+        height, width = frame.shape[:2]
+        size = (min(width, self.width), max(1, height * min(width, self.width) // width))
+
+        # Shrinking first makes everything after it nearly free
+        self.small = cv2.resize(frame, size, dst = self.small, interpolation = cv2.INTER_AREA)
+        if self.small.ndim == 3:
+            grey = cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY)
+        else:
+            grey = self.small.copy()
+        if self.blur:
+            grey = cv2.GaussianBlur(grey, (self.blur, self.blur), 0)
+
+        moving = True
+        if self.background is not None and self.background.shape == grey.shape:
+            self.reference = cv2.convertScaleAbs(self.background, dst = self.reference)
+            self.delta = cv2.absdiff(grey, self.reference, dst = self.delta)
+            _, self.changed = cv2.threshold(self.delta, self.threshold, 255, cv2.THRESH_BINARY
+                , dst = self.changed)
+            moving = cv2.countNonZero(self.changed) > self.min_changed * grey.size
+            cv2.accumulateWeighted(grey, self.background, self.rate)
+        else:
+            self.background = grey.astype(np.float32)
+
+        self.checked += 1
+        self.check_time += clock() - start
+        return moving
+
+    def feed_due(self):
+        """Called for every skipped frame, True when this one should train the background model."""
+        self.skipped += 1
+        self.since_feed += 1
+        if self.since_feed >= self.feed_every:
+            self.since_feed = 0
+            return True
+        return False
+
+    def learning_rate(self, rate):
+        """The learning rate of a fed frame, so the model adapts as fast as if it saw every frame."""
+        return min(1.0, rate * self.feed_every)
+
+    def record_feed(self, start):
+        self.fed += 1
+        self.feed_time += clock() - start
+
+    def record_full(self, start):
+        """Time a frame that went the full way, from the end of its check."""
+        self.full_frames += 1
+        self.full_time += clock() - start
+
+    def summary(self):
+        mean_full = self.full_time / self.full_frames if self.full_frames else 0.0
+        saved = self.skipped * mean_full - self.check_time - self.feed_time
+        return {"checked": self.checked
+            , "skipped": self.skipped
+            , "fed": self.fed
+            , "hit_rate": round(float(self.skipped) / self.checked, 4) if self.checked else 0.0
+            , "check_ms": round(1000.0 * self.check_time / self.checked, 3) if self.checked else 0.0
+            , "saved_ms": int(round(1000.0 * saved))}
+
+# ============================================================================
@@ -0,0 +1,213 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Count several cameras in one process, their frames analysed in turn
+# ---              by a fixed pool of worker threads
+# ------------------------------------------
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import Metrics, clock
+from realtime import LatestFrameReader
+
+# ============================================================================
+
+# What Camera.read() found
+READ_OK = "ok"              # a frame to analyse
+READ_NOT_YET = "not_yet"    # a live camera without a new frame since the last one
+READ_ENDED = "ended"        # the source ended or failed
+
+# ============================================================================
+
+def camera_name(source):
+    """A short name of a source, the device index or the file name without extension."""
+    if isinstance(source, int):
+        return "camera%d" % source
+    return os.path.splitext(os.path.basename(source.rstrip("/")))[0] or source
+
+
+def is_live(source):
+    """Device indexes and network streams deliver frames at their own pace, files do not."""
+    return isinstance(source, int) or "://" in source
+
+
+def camera_names(sources):
+    """Unique names for the sources, in the same order."""
+    names = []
+    for source in sources:
+        name = camera_name(source)
+        unique = name
+        n = 1
+        while unique in names:
+            n += 1
+            unique = "%s_%d" % (name, n)
+        names.append(unique)
+    return names
+
+# ============================================================================
+
+class Camera(object):
+    """One source of a MultiCameraService, and all it keeps from one frame to the next.
+
+    Every camera has its own background model, vehicle counter, buffers,
+    region of interest and metrics, and the service never analyses two
+    frames of the same camera at once, so none of them needs a lock. The
+    tracer is shared by all of them, so it cannot be used with several
+    cameras.
+
+    A live camera is read on a thread of its own that keeps only the newest
+    frame, so a camera the workers cannot keep up with drops frames instead
+    of lagging. A video file is read by the worker analysing it, every
+    `stride`-th frame, so no frame of it is lost.
+    """
+    def __init__(self, name, source, cap, bg_subtractor, context, bg_cache=None, motion_gate=None
+        , reporter=None, roi=None, fps=None, stride=1, live=False):
+        self.name = name
+        self.source = source
+        self.cap = cap
+        self.fps = fps
+        self.bg_subtractor = bg_subtractor
+        self.context = context
+        self.bg_cache = bg_cache
+        self.motion_gate = motion_gate
+        self.reporter = reporter
+        self.roi = roi
+        self.stride = max(1, stride)
+        self.car_counter = None  # created on the first frame, from its size
+
+        self.metrics = Metrics()
+        self.reader = LatestFrameReader(cap) if live else None
+        self.frame = None
+        self.frame_number = -1
+        self.analysed = -1  # the number of the frame analysed last
+        self.ended = False
+
+    def read(self):
+        """The next frame to analyse, as (READ_*, frame_number, frame)."""
+        t = clock()
+        if self.reader is not None:
+            ret, frame, frame_number, _, dropped = self.reader.read(timeout = 0)
+            if not ret:
+                return (READ_ENDED if self.reader.ended else READ_NOT_YET), self.frame_number, None
+            skipped = dropped
+        else:
+            # The previous frame is analysed already, so decode straight into it
+            skipped = 0
+            while skipped < self.stride - 1:
+                if not self.cap.grab():
+                    return READ_ENDED, self.frame_number, None
+                skipped += 1
+            if self.frame is not None:
+                ret, frame = self.cap.read(self.frame)
+            else:
+                ret, frame = self.cap.read()
+            if not ret:
+                return READ_ENDED, self.frame_number, None
+            frame_number = self.frame_number + skipped + 1
+
+        self.metrics.record("read", t)
+        self.metrics.frame(skipped)
+        self.frame = frame
+        self.frame_number = frame_number
+        return READ_OK, frame_number, frame
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.stop()
+        self.cap.release()
+        self.metrics.finish()
+
+# ============================================================================
+
+class MultiCameraService(object):
+    """Analyses the frames of several cameras with a fixed pool of worker threads.
+
+    The cameras take turns: a worker takes the camera at the head of the
+    queue, reads and analyses one of its frames with `analyse(camera,
+    frame_number, frame)`, and puts it back at the tail. Each camera thus
+    gets one frame analysed per round, however many frames the others could
+    deliver, and the pool stays busy as long as there are at least as many
+    cameras as workers. The heavy OpenCV calls release the GIL, so the
+    workers do run in parallel.
+
+    run() returns once every camera ended, or stop_event is set.
+    """
+    def __init__(self, cameras, analyse, workers=2, stop_event=None):
+        self.log = logging.getLogger("multi_camera")
+        self.cameras = list(cameras)
+        self.analyse = analyse
+        self.workers = max(1, workers)
+        self.stop_event = stop_event
+
+        self.cond = threading.Condition()
+        self.ready = deque(self.cameras)
+        self.active = len(self.cameras)
+        # Cameras in a row that had no new frame, all of them means nothing to do
+        self.misses = 0
+
+    def _stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def _next_camera(self):
+        with self.cond:
+            while True:
+                if self.active == 0 or self._stopped():
+                    return None
+                if self.ready and self.misses < len(self.ready):
+                    return self.ready.popleft()
+                self.misses = 0
+                # Every camera is either being analysed, or live without a new frame
+                self.cond.wait(0.005)
+
+    def _done_with(self, camera, status):
+        with self.cond:
+            if status == READ_ENDED:
+                camera.ended = True
+                self.active -= 1
+                self.log.info("Camera '%s' ended after %d frames.", camera.name, camera.frame_number + 1)
+            else:
+                self.misses = self.misses + 1 if status == READ_NOT_YET else 0
+                self.ready.append(camera)
+            self.cond.notify_all()
+        if status == READ_ENDED:
+            # Stops its clock now, not once every other camera ended too
+            camera.close()
+
+    def _work(self):
+        while True:
+            camera = self._next_camera()
+            if camera is None:
+                break
+
+            status = READ_ENDED
+            try:
+                status, frame_number, frame = camera.read()
+                if status == READ_OK:
+                    t = clock()
+                    self.analyse(camera, frame_number, frame)
+                    camera.metrics.record("frame", t)
+            except Exception:
+                self.log.exception("Analysing camera '%s' failed, dropping it.", camera.name)
+                status = READ_ENDED
+            self._done_with(camera, status)
+
+    def run(self):
+        self.log.info("Counting %d cameras with %d workers...", len(self.cameras), self.workers)
+        started = time.time()
+        threads = [threading.Thread(target=self._work, name="camera_worker_%d" % i)
+            for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for camera in self.cameras:
+            if not camera.ended:
+                camera.close()
+        self.log.info("%d cameras counted in %.1f s.", len(self.cameras), time.time() - started)
+
+# ============================================================================
@@ -0,0 +1,255 @@
+# ------------------------------------------
+# --- Author: Bing
+# --- Version: 1.0
+# --- Description: Durable outbox for MQTT reports, so nothing is lost while offline
+# ---              (the same file is in AWS_IoT/ and Vehicle_Counting/, keep them in sync)
+# ------------------------------------------
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# ============================================================================
+
+# paho.mqtt return code of a successful publish
+MQTT_ERR_SUCCESS = 0
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    qos INTEGER NOT NULL,
+    created REAL NOT NULL)"""
+
+# ============================================================================
+
+class Outbox(object):
+    """Keeps every outgoing message in SQLite until the broker acknowledged it.
+
+    add() only appends to a bounded in-memory queue and returns. One thread
+    owns the database: it inserts the queued messages in batches, one commit
+    per `commit_interval` seconds or `batch_size` messages, and while the
+    client is connected publishes the stored messages in the order they were
+    added, at most `rate` per second and `max_in_flight` waiting for their
+    PUBACK. Acknowledged messages are deleted, and the file is compacted
+    every `compact_every` deletions.
+
+    After a disconnect every message not acknowledged yet is published again
+    from the oldest, also the ones stored before a reboot. Messages are thus
+    delivered at least once. If the disk cannot keep up, the in-memory queue
+    drops its oldest message once it holds `max_queued`, and the database
+    drops its oldest messages beyond `max_rows`, so neither memory nor disk
+    grow without bound.
+
+    It chains itself into the on_connect, on_disconnect and on_publish
+    callbacks of the client, so create it after setting those.
+    """
+    def __init__(self, path, client, batch_size=50, commit_interval=1.0, rate=5.0, max_in_flight=10
+        , max_queued=1000, max_rows=100000, compact_every=1000):
+        self.log = logging.getLogger("outbox")
+
+        self.path = path
+        self.client = client
+        self.batch_size = max(1, batch_size)
+        self.commit_interval = commit_interval
+        self.min_gap = 1.0 / rate if rate > 0 else 0.0
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queued = max(1, max_queued)
+        self.max_rows = max_rows
+        self.compact_every = compact_every
+
+        self.cond = threading.Condition()
+        self.queued = deque()
+        self.acks = deque()
+        self.connected = bool(getattr(client, "is_connected", lambda: False)())
+        self.reconnected = True
+        self.closing = False
+
+        # Only used by the outbox thread
+        self.in_flight = {}       # mid -> row id
+        self.cursor = 0           # the last row id published since connecting
+        self.last_sent = 0.0
+        self.deleted = 0
+
+        self.added = 0
+        self.dropped = 0
+        self.sent = 0
+        self.delivered = 0
+
+        self.chained_on_connect = client.on_connect
+        self.chained_on_disconnect = client.on_disconnect
+        self.chained_on_publish = client.on_publish
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+
+        self.thread = threading.Thread(target=self._run, name="outbox")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # ------------------------------------------------------------------------
+    # Any thread
+
+    def add(self, topic, payload, qos=1):
+        """Queue a message to be stored and published, never blocks on the disk or network."""
+        with self.cond:
+            if len(self.queued) >= self.max_queued:
+                self.queued.popleft()
+                self.dropped += 1
+            self.queued.append((topic, payload, qos, time.time()))
+            self.added += 1
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {"added": self.added, "dropped": self.dropped, "sent": self.sent
+                , "delivered": self.delivered, "queued": len(self.queued)
+                , "in_flight": len(self.in_flight), "connected": self.connected}
+
+    def close(self, timeout=5.0):
+        """Store what is queued, wait up to `timeout` seconds for the messages in flight, and stop."""
+        with self.cond:
+            self.closing = True
+            self.close_deadline = time.time() + timeout
+            self.cond.notify_all()
+        self.thread.join(timeout + 1.0)
+        self.log.info("Outbox closed: %(added)d added, %(delivered)d delivered, %(dropped)d dropped.", self.stats())
+
+    # ------------------------------------------------------------------------
+    # The network thread
+
+    def _on_connect(self, client, userdata, flags, rc):
+        with self.cond:
+            if rc == 0:
+                self.connected = True
+                self.reconnected = True
+            self.cond.notify_all()
+        if self.chained_on_connect is not None:
+            self.chained_on_connect(client, userdata, flags, rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self.cond:
+            self.connected = False
+            self.cond.notify_all()
+        if self.chained_on_disconnect is not None:
+            self.chained_on_disconnect(client, userdata, rc)
+
+    def _on_publish(self, client, userdata, mid):
+        with self.cond:
+            self.acks.append(mid)
+            self.cond.notify_all()
+        if self.chained_on_publish is not None:
+            self.chained_on_publish(client, userdata, mid)
+
+    # ------------------------------------------------------------------------
+    # The outbox thread
+
+    def _open(self):
+        db = sqlite3.connect(self.path)
+        # Must come before the table exists to take effect
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode a crash can only lose the last commits, never corrupt the file
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute(SCHEMA)
+        db.commit()
+        backlog = db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if backlog:
+            self.log.info("%d messages of an earlier run are waiting to be published.", backlog)
+        return db
+
+    def _store(self, db, messages):
+        db.executemany("INSERT INTO outbox (topic, payload, qos, created) VALUES (?, ?, ?, ?)", messages)
+        if self.max_rows:
+            db.execute("DELETE FROM outbox WHERE id <= (SELECT MAX(id) FROM outbox) - ?", (self.max_rows,))
+
+    def _acknowledge(self, db, mids):
+        ids = []
+        for mid in mids:
+            # The acknowledgements are taken before publishing, so an unknown one was
+            # published by someone else (the shadow GET), or before reconnecting
+            row_id = self.in_flight.pop(mid, None)
+            if row_id is not None:
+                ids.append((row_id,))
+        if ids:
+            db.executemany("DELETE FROM outbox WHERE id = ?", ids)
+            self.deleted += len(ids)
+        return len(ids)
+
+    def _compact(self, db):
+        db.execute("PRAGMA incremental_vacuum")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.deleted = 0
+
+    def _publish(self, db):
+        """Publish the next stored messages the rate and the in-flight limit allow."""
+        sent = 0
+        while len(self.in_flight) < self.max_in_flight and time.time() - self.last_sent >= self.min_gap:
+            row = db.execute("SELECT id, topic, payload, qos FROM outbox WHERE id > ? ORDER BY id LIMIT 1"
+                , (self.cursor,)).fetchone()
+            if row is None:
+                break
+            row_id, topic, payload, qos = row
+
+            info = self.client.publish(topic, payload, qos=qos)
+            rc, mid = info[0], info[1]
+            self.last_sent = time.time()
+            if rc != MQTT_ERR_SUCCESS:
+                # Not connected after all, on_connect starts over from the oldest message
+                self.log.debug("Publishing message #%d failed (rc=%d).", row_id, rc)
+                break
+            self.cursor = row_id
+            sent += 1
+            if qos == 0:
+                db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+                self.deleted += 1
+            else:
+                self.in_flight[mid] = row_id
+        return sent
+
+    def _run(self):
+        db = self._open()
+        pending = []
+        last_commit = time.time()
+        while True:
+            with self.cond:
+                if not (self.queued or self.acks or self.closing):
+                    self.cond.wait(min(0.1, self.min_gap or 0.1) if self.connected else 0.5)
+                while self.queued:
+                    pending.append(self.queued.popleft())
+                mids = list(self.acks)
+                self.acks.clear()
+                connected = self.connected
+                if self.reconnected:
+                    # Everything not acknowledged goes out again, oldest first
+                    self.reconnected = False
+                    self.cursor = 0
+                    self.in_flight.clear()
+                closing = self.closing
+
+            delivered = self._acknowledge(db, mids)
+            due = len(pending) >= self.batch_size or time.time() - last_commit >= self.commit_interval
+            if pending and (due or closing):
+                self._store(db, pending)
+                pending = []
+            if delivered or due or closing:
+                db.commit()
+                last_commit = time.time()
+
+            sent = self._publish(db) if connected else 0
+            if sent:
+                db.commit()
+            if self.compact_every and self.deleted >= self.compact_every:
+                self._compact(db)
+
+            with self.cond:
+                self.sent += sent
+                self.delivered += delivered
+                done = closing and (not self.in_flight or not connected or time.time() >= self.close_deadline)
+            if done:
+                break
+        db.commit()
+        db.close()
+
+# ============================================================================
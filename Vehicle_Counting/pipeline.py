@@ -0,0 +1,177 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Staged capture -> process -> render pipeline, each stage on its own thread
+# ------------------------------------------
+import logging
+import threading
+import time
+from collections import deque
+
+# ============================================================================
+
+# What a full queue does with a new frame
+POLICY_BLOCK = "block"              # wait until the next stage catches up
+POLICY_DROP_OLDEST = "drop-oldest"  # throw away the oldest queued frame
+
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST)
+
+# Marks the end of the stream as it travels down the pipeline
+END_OF_STREAM = object()
+
+# ============================================================================
+
+class StageQueue(object):
+    """Bounded FIFO between two stages.
+
+    Unlike Queue.Queue it can evict the oldest item when full, which is
+    what we want for live cameras that should never fall behind.
+    """
+    def __init__(self, name, maxsize, policy=POLICY_BLOCK):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy '%s'" % policy)
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.policy = policy
+
+        self.items = deque()
+        self.cond = threading.Condition()
+
+        self.put_count = 0
+        self.drop_count = 0
+        self.max_depth = 0
+
+    def put(self, item, stop_event=None):
+        with self.cond:
+            # The end of stream marker is never dropped nor blocked on
+            if item is not END_OF_STREAM:
+                while len(self.items) >= self.maxsize:
+                    if self.policy == POLICY_DROP_OLDEST:
+                        self.items.popleft()
+                        self.drop_count += 1
+                    elif stop_event is not None and stop_event.is_set():
+                        return False
+                    else:
+                        self.cond.wait(0.1)
+                self.put_count += 1
+            self.items.append(item)
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        with self.cond:
+            while not self.items:
+                self.cond.wait(0.1)
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def depth(self):
+        with self.cond:
+            return len(self.items)
+
+    def stats(self):
+        with self.cond:
+            return {"depth": len(self.items)
+                , "max_depth": self.max_depth
+                , "put": self.put_count
+                , "dropped": self.drop_count}
+
+# ============================================================================
+
+class FramePipeline(object):
+    """Runs a frame source and a chain of stages, one thread each.
+
+    `source` is called with no arguments and returns the next item, or None
+    at the end of the stream. Every stage function takes an item and
+    returns the item for the next stage; returning None drops the item.
+    Each stage has a single thread and the queues are FIFO, so the order of
+    frames is preserved. A stage given as (name, func, policy) uses that
+    policy for the queue in front of it instead of `policy`.
+    """
+    def __init__(self, source, stages, maxsize=4, policy=POLICY_BLOCK):
+        self.log = logging.getLogger("pipeline")
+
+        self.source = source
+        self.stages = list(stages)
+        self.stop_event = threading.Event()
+        self.errors = []
+
+        # One queue in front of every stage
+        self.queues = [StageQueue(stage[0], maxsize, stage[2] if len(stage) > 2 else policy)
+            for stage in self.stages]
+
+        self.threads = [threading.Thread(target=self._run_source, name="capture")]
+        for i, (name, func) in enumerate(stage[:2] for stage in self.stages):
+            outbox = self.queues[i + 1] if i + 1 < len(self.queues) else None
+            self.threads.append(threading.Thread(target=self._run_stage
+                , name=name, args=(func, self.queues[i], outbox)))
+        for thread in self.threads:
+            thread.daemon = True
+
+    def _run_source(self):
+        outbox = self.queues[0]
+        try:
+            while not self.stop_event.is_set():
+                item = self.source()
+                if item is None:
+                    break
+                if not outbox.put(item, self.stop_event):
+                    break
+        except Exception:
+            self.log.exception("Capture stage failed, stopping...")
+            self.errors.append("capture")
+            self.stop_event.set()
+        outbox.put(END_OF_STREAM)
+
+    def _run_stage(self, func, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is END_OF_STREAM:
+                break
+            try:
+                item = func(item)
+            except Exception:
+                self.log.exception("Stage '%s' failed, stopping...", inbox.name)
+                self.errors.append(inbox.name)
+                self.stop_event.set()
+                continue
+            if item is not None and outbox is not None:
+                outbox.put(item, self.stop_event)
+        if outbox is not None:
+            outbox.put(END_OF_STREAM)
+
+    def stop(self):
+        """Ask the capture stage to stop, the rest of the pipeline drains."""
+        self.stop_event.set()
+
+    def queue_depths(self):
+        return dict((q.name, q.depth()) for q in self.queues)
+
+    def stats(self):
+        return dict((q.name, q.stats()) for q in self.queues)
+
+    def run(self, report_interval=5.0):
+        """Start every stage and wait for the stream to end.
+
+        The calling thread only monitors, logging the queue depths every
+        `report_interval` seconds.
+        """
+        for thread in self.threads:
+            thread.start()
+
+        last_report = time.time()
+        while any(thread.is_alive() for thread in self.threads):
+            self.threads[-1].join(0.1)
+            if report_interval and (time.time() - last_report) >= report_interval:
+                last_report = time.time()
+                self.log.debug("Queue depths: %s", self.queue_depths())
+
+        for name, stats in sorted(self.stats().items()):
+            self.log.debug("Queue '%s': %s", name, stats)
+
+        if self.errors:
+            raise RuntimeError("Pipeline stage(s) failed: %s" % ", ".join(self.errors))
+
+# ============================================================================
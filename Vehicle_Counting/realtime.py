@@ -0,0 +1,194 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Building blocks of the real-time mode: always analyse the newest frame,
+# ---              and shed work step by step when the frames miss their deadline
+# ------------------------------------------
+import logging
+import threading
+import time
+
+# ============================================================================
+
+# Degradation levels, each one also does what the ones before it do
+LEVEL_FULL = 0         # everything
+LEVEL_NO_DRAWING = 1   # no annotated frame is drawn
+LEVEL_DOWNSCALE = 2    # the background model runs on a smaller grey frame
+LEVEL_SKIP_FRAMES = 3  # only every other new frame is analysed
+
+LEVEL_NAMES = ["full", "no_drawing", "downscale", "skip_frames"]
+
+# ============================================================================
+
+class LatestFrameReader(object):
+    """Reads a capture on its own thread and only keeps the newest frame.
+
+    Camera drivers queue the frames nobody read yet, so a slow reader sees
+    older and older frames. This thread reads as fast as the source delivers,
+    and read() hands out the newest frame, dropping the ones in between.
+
+    `pace_fps` makes a video file behave like a camera: the frames are read
+    at that rate instead of as fast as they decode.
+    """
+    def __init__(self, cap, pace_fps=None):
+        self.log = logging.getLogger("latest_frame_reader")
+        self.cap = cap
+        self.pace = 1.0 / pace_fps if pace_fps and pace_fps > 0 else None
+
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.ended = False
+
+        # Three buffers, so the reader always has one that is neither the
+        # newest frame nor the one held by the caller
+        self.buffers = [None, None, None]
+        self.latest = -1
+        self.held = -1
+        self.latest_number = -1
+        self.latest_time = 0.0
+        self.returned_number = -1
+
+        self.thread = threading.Thread(target=self._run, name="latest_frame_reader")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        started = time.time()
+        frames = 0
+        while True:
+            with self.cond:
+                if self.stopped:
+                    break
+                free = [i for i in range(3) if i != self.latest and i != self.held][0]
+            buffer = self.buffers[free]
+            if buffer is not None:
+                ret, frame = self.cap.read(buffer)
+            else:
+                ret, frame = self.cap.read()
+            now = time.time()
+
+            with self.cond:
+                if not ret:
+                    self.ended = True
+                    self.cond.notify_all()
+                    break
+                self.buffers[free] = frame
+                self.latest = free
+                self.latest_number = frames
+                self.latest_time = now
+                self.cond.notify_all()
+            frames += 1
+
+            if self.pace is not None:
+                delay = started + frames * self.pace - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def read(self, timeout=5.0):
+        """The newest frame not handed out yet.
+
+        Returns (ret, frame, frame_number, capture time, frames dropped since
+        the last read). The frame stays valid until the next call.
+        """
+        with self.cond:
+            waited = 0.0
+            while self.latest_number <= self.returned_number and not self.ended and waited < timeout:
+                self.cond.wait(0.1)
+                waited += 0.1
+            if self.latest_number <= self.returned_number:
+                return False, None, self.returned_number, time.time(), 0
+
+            dropped = self.latest_number - self.returned_number - 1
+            self.held = self.latest
+            self.returned_number = self.latest_number
+            return True, self.buffers[self.held], self.latest_number, self.latest_time, dropped
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+        self.thread.join()
+
+# ============================================================================
+
+class DeadlineController(object):
+    """Picks the degradation level from how late the analysed frames are.
+
+    The lateness of a frame is the time from its capture until it was fully
+    handled. When the smoothed lateness exceeds the deadline, the level goes
+    up one step, and it goes down one step again after `relax_frames` frames
+    in a row finished within `relax_ratio` of the deadline. After a change the
+    level is kept for `settle_frames` frames, to see its effect first.
+    """
+    def __init__(self, deadline, max_level=LEVEL_SKIP_FRAMES, smoothing=0.2, relax_ratio=0.6
+        , relax_frames=30, settle_frames=10):
+        self.log = logging.getLogger("deadline_controller")
+
+        self.deadline = deadline
+        self.max_level = max_level
+        self.smoothing = smoothing
+        self.relax_ratio = relax_ratio
+        self.relax_frames = relax_frames
+        self.settle_frames = settle_frames
+
+        self.level = LEVEL_FULL
+        self.lateness = None
+        self.on_time = 0
+        self.settle = 0
+        self.usage = [0] * (max_level + 1)
+
+    def update(self, lateness):
+        """Record the lateness of the frame handled at the current level, returns the next level."""
+        self.usage[self.level] += 1
+        if self.lateness is None:
+            self.lateness = lateness
+        else:
+            self.lateness += self.smoothing * (lateness - self.lateness)
+        self.on_time = self.on_time + 1 if lateness <= self.relax_ratio * self.deadline else 0
+
+        if self.settle > 0:
+            self.settle -= 1
+        elif self.lateness > self.deadline and self.level < self.max_level:
+            self._change(self.level + 1)
+        elif self.on_time >= self.relax_frames and self.level > LEVEL_FULL:
+            self._change(self.level - 1)
+        return self.level
+
+    def _change(self, level):
+        self.log.info("%.1f ms late against a %.1f ms deadline, degradation level %s -> %s."
+            , 1000.0 * self.lateness, 1000.0 * self.deadline
+            , LEVEL_NAMES[self.level], LEVEL_NAMES[level])
+        self.level = level
+        self.on_time = 0
+        self.settle = self.settle_frames
+
+    def usage_counts(self):
+        """The number of frames handled at each level, by level name."""
+        return dict((LEVEL_NAMES[level], n) for level, n in enumerate(self.usage))
+
+# ============================================================================
+
+class DegradableModel(object):
+    """A background model that can switch to a cheaper, downscaled one and back.
+
+    Both are trained on the frame of the switch, so the counting carries on
+    with a usable model either way.
+    """
+    def __init__(self, model, small_model):
+        self.model = model
+        self.small_model = small_model
+        self.downscaled = False
+        self.switched = False
+
+    def set_downscaled(self, downscaled):
+        if downscaled != self.downscaled:
+            self.downscaled = downscaled
+            self.switched = True
+
+    def apply(self, frame, fg_mask=None, learning_rate=-1):
+        model = self.small_model if self.downscaled else self.model
+        if self.switched:
+            self.switched = False
+            learning_rate = 1.0
+        return model.apply(frame, fg_mask, learning_rate)
+
+# ============================================================================
@@ -0,0 +1,95 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Rolling-window count reports while a counting session runs
+# ------------------------------------------
+import logging
+import threading
+import time
+
+from pipeline import StageQueue, END_OF_STREAM, POLICY_DROP_OLDEST
+
+# ============================================================================
+
+class RollingReporter(object):
+    """Reports the counts of the last `interval` seconds while counting.
+
+    update() is called once per analysed frame and only compares the time
+    with the next report time, a report keeps just the count at the start
+    of its window. The reports are handed to `publish(report)` on a thread
+    of its own, through a small queue that drops the oldest report when the
+    publisher falls behind, so the counting never waits for the network.
+
+    The time is the position in the source (frame number / fps), which for a
+    camera is the wall time, and for a video file the traffic time of the
+    clip. Without a frame rate the wall time is used.
+
+    A report has the same keys as the shadow report at the end of a session,
+    plus the counts of the window:
+      Number, During, Frequency   cumulative count, seconds, vehicles / second
+      Window                      {Number, During, Frequency} of the last window
+    """
+    def __init__(self, interval, fps, publish, maxsize=4):
+        self.log = logging.getLogger("rolling_reporter")
+
+        self.interval = max(1e-3, float(interval))
+        self.fps = fps if fps and fps > 0 else None
+        self.publish = publish
+
+        self.started = time.time()
+        self.window_start = 0.0
+        self.window_count = 0
+        self.next_report = self.interval
+        self.reports = 0
+
+        self.queue = StageQueue("reports", maxsize, POLICY_DROP_OLDEST)
+        self.thread = threading.Thread(target=self._run, name="rolling_reporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _now(self, frame_number):
+        if self.fps is not None:
+            return frame_number / self.fps
+        return time.time() - self.started
+
+    def update(self, frame_number, vehicle_count):
+        now = self._now(frame_number)
+        if now < self.next_report:
+            return
+
+        during = now - self.window_start
+        number = vehicle_count - self.window_count
+        report = {"Counting": "ON"
+            , "Number": vehicle_count
+            , "During": round(now, 3)
+            , "Frequency": round(vehicle_count / now, 4) if now > 0 else 0.0
+            , "Window": {"Number": number
+                , "During": round(during, 3)
+                , "Frequency": round(number / during, 4) if during > 0 else 0.0}}
+
+        self.window_start = now
+        self.window_count = vehicle_count
+        # Windows stay aligned to the interval, even when frames were skipped
+        while self.next_report <= now:
+            self.next_report += self.interval
+        self.queue.put(report)
+
+    def _run(self):
+        while True:
+            report = self.queue.get()
+            if report is END_OF_STREAM:
+                break
+            try:
+                self.publish(report)
+                self.reports += 1
+            except Exception:
+                self.log.exception("Unable to publish a count report.")
+
+    def close(self):
+        """Publish what is still queued and stop the publishing thread."""
+        self.queue.put(END_OF_STREAM)
+        self.thread.join()
+        self.log.debug("%d count reports published, %d dropped.", self.reports
+            , self.queue.stats()["dropped"])
+
+# ============================================================================
@@ -0,0 +1,98 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Region of interest, so the counting pipeline only looks at the road
+# ------------------------------------------
+import cv2
+import numpy as np
+
+# ============================================================================
+
+def parse_rect(text):
+    """Parse 'x,y,w,h' into a tuple of ints."""
+    values = [int(v) for v in text.split(",")]
+    if len(values) != 4 or values[2] <= 0 or values[3] <= 0:
+        raise ValueError("Expected a rectangle as 'x,y,w,h', got '%s'" % text)
+    return tuple(values)
+
+
+def parse_polygon(text):
+    """Parse 'x1,y1;x2,y2;x3,y3;...' into a list of (x, y) points."""
+    points = [tuple(int(v) for v in point.split(",")) for point in text.split(";") if point.strip()]
+    if len(points) < 3 or any(len(point) != 2 for point in points):
+        raise ValueError("Expected a polygon as 'x1,y1;x2,y2;x3,y3;...', got '%s'" % text)
+    return points
+
+# ============================================================================
+
+class RegionOfInterest(object):
+    """A rectangle to crop every frame to, plus an optional polygon mask.
+
+    Background modelling, morphology and contour search then only run on
+    the cropped pixels. Without a rectangle the bounding box of the polygon
+    is used. Everything is given in full frame coordinates.
+    """
+    def __init__(self, rect=None, polygon=None):
+        if rect is None and polygon is None:
+            raise ValueError("A region of interest needs a rectangle or a polygon")
+        self.rect = rect
+        self.polygon = polygon
+
+        # Computed once the frame size is known
+        self.shape = None
+        self.bounds = None
+        self.mask = None
+
+    def bind(self, shape):
+        """Clip the region to a frame of the given shape, and build the polygon mask."""
+        shape = tuple(shape[:2])
+        if shape == self.shape:
+            return
+        height, width = shape
+
+        if self.rect is not None:
+            x, y, w, h = self.rect
+        else:
+            x, y, w, h = cv2.boundingRect(np.array(self.polygon, np.int32))
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(width, x + w), min(height, y + h)
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError("Region of interest %s is outside the %dx%d frame"
+                % ((x, y, w, h), width, height))
+
+        self.shape = shape
+        self.bounds = (x0, y0, x1 - x0, y1 - y0)
+
+        self.mask = None
+        if self.polygon is not None:
+            self.mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+            points = np.array(self.polygon, np.int32) - np.array([x0, y0], np.int32)
+            cv2.fillPoly(self.mask, [points], 255)
+
+    def crop(self, frame):
+        """A view of the region inside the frame, no pixels are copied."""
+        self.bind(frame.shape)
+        x, y, w, h = self.bounds
+        return frame[y:y + h, x:x + w]
+
+    def apply_mask(self, fg_mask):
+        """Clear the foreground outside of the polygon, in place."""
+        if self.mask is not None:
+            cv2.bitwise_and(fg_mask, self.mask, fg_mask)
+        return fg_mask
+
+    def to_frame(self, matches):
+        """Map ((x, y, w, h), centroid) matches from region to frame coordinates."""
+        ox, oy = self.bounds[:2]
+        if ox == 0 and oy == 0:
+            return matches
+        return [((x + ox, y + oy, w, h), (cx + ox, cy + oy))
+            for ((x, y, w, h), (cx, cy)) in matches]
+
+    def draw(self, output_image, colour):
+        x, y, w, h = self.bounds
+        cv2.rectangle(output_image, (x, y), (x + w - 1, y + h - 1), colour, 1)
+        if self.polygon is not None:
+            cv2.polylines(output_image, [np.array(self.polygon, np.int32)], True, colour, 1)
+
+# ============================================================================
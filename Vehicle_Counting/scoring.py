@@ -0,0 +1,107 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Score the counted vehicles of a clip against hand labelled ground truth
+# ---
+# --- The ground truth of video/clip.avi is video/clip.truth.json:
+# ---   {
+# ---     "video": "clip.avi",
+# ---     "tolerance": 15,
+# ---     "crossings": [12, 40, 41, 97, ...]
+# ---   }
+# --- crossings holds one frame number (0 = first frame of the clip) per vehicle,
+# --- the frame in which it enters the counted region. A counted vehicle matches a
+# --- crossing at most `tolerance` frames away (optional, DEFAULT_TOLERANCE).
+# ------------------------------------------
+import logging
+import argparse
+import json
+import os
+
+import main as counting
+
+# ============================================================================
+
+TRUTH_SUFFIX = ".truth.json"
+
+# Frames between a labelled crossing and the frame its vehicle was counted in
+DEFAULT_TOLERANCE = 15
+
+# ============================================================================
+
+def truth_path(video):
+    """Where the ground truth of a video is kept."""
+    return os.path.splitext(video)[0] + TRUTH_SUFFIX
+
+
+def load_truth(path):
+    """The ground truth in `path` with its crossings sorted, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        truth = json.load(f)
+    truth["crossings"] = sorted(int(n) for n in truth.get("crossings", []))
+    truth.setdefault("tolerance", DEFAULT_TOLERANCE)
+    return truth
+
+
+def match_counts(counted, crossings, tolerance=DEFAULT_TOLERANCE):
+    """The number of counted frames paired one to one with a crossing at most `tolerance` away.
+
+    Both lists must be sorted. Pairing them in order is a maximum matching,
+    since every crossing accepts the same window of frames around it.
+    """
+    i = j = matched = 0
+    while i < len(counted) and j < len(crossings):
+        if counted[i] < crossings[j] - tolerance:
+            i += 1  # counted nothing real
+        elif counted[i] > crossings[j] + tolerance:
+            j += 1  # missed this vehicle
+        else:
+            matched += 1
+            i += 1
+            j += 1
+    return matched
+
+
+def score(counted, truth):
+    """Precision, recall and count error of the frames vehicles were counted in."""
+    counted = sorted(counted)
+    crossings = truth["crossings"]
+    matched = match_counts(counted, crossings, truth["tolerance"])
+
+    return {"truth": len(crossings)
+        , "counted": len(counted)
+        , "true_positives": matched
+        , "false_positives": len(counted) - matched
+        , "false_negatives": len(crossings) - matched
+        , "precision": round(float(matched) / len(counted), 4) if counted else 1.0
+        , "recall": round(float(matched) / len(crossings), 4) if crossings else 1.0
+        , "count_error": len(counted) - len(crossings)
+        , "count_error_pct": round(100.0 * (len(counted) - len(crossings)) / len(crossings), 2)
+            if crossings else 0.0}
+
+# ============================================================================
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Count the vehicles of a clip and score them against its ground truth")
+    ap.add_argument("-v", "--video", required=True, help="The path to the video file")
+    ap.add_argument("-t", "--truth", help="The ground truth file, next to the video by default")
+    return ap.parse_args()
+
+# ============================================================================
+
+if __name__ == "__main__":
+    args = parse_args()
+    log = counting.init_logging()
+    log.setLevel(logging.INFO)
+
+    truth = load_truth(args.truth or truth_path(args.video))
+    if truth is None:
+        log.error("No ground truth for '%s'.", args.video)
+    else:
+        counting.HEADLESS = True
+        counting.BG_CACHE_DIR = None
+        counting.RECORD_COUNTS = True
+        counting.main(args.video)
+        log.info("%s: %s", args.video, json.dumps(score(counting.COUNTED_FRAMES, truth), sort_keys=True))
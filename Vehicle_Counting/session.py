@@ -0,0 +1,118 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Run counting sessions on a thread of their own, started and stopped
+# ---              from the MQTT callbacks without ever blocking them
+# ------------------------------------------
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# ============================================================================
+
+STATE_IDLE = "idle"
+STATE_RUNNING = "running"
+STATE_STOPPING = "stopping"
+
+_SHUTDOWN = object()
+
+# ============================================================================
+
+class SessionManager(object):
+    """Runs one counting session at a time on the thread calling serve_forever().
+
+    start() and stop() only post a request and return at once, so they can
+    be called from the MQTT network thread. `run_session(stop_event)` counts
+    until the video ends or stop_event is set, and its result is passed to
+    `on_finished(result, stopped)`, stopped being True if stop() ended it.
+
+    A start() while a session is running is merged into that session, a
+    stop() while none is running does nothing. A start() while a session is
+    stopping is remembered, and a new session starts as soon as that one
+    ended, unless a stop() cancels it first. Both return whether they
+    changed anything.
+    """
+    def __init__(self, run_session, on_finished):
+        self.log = logging.getLogger("session_manager")
+        self.run_session = run_session
+        self.on_finished = on_finished
+
+        self.lock = threading.Lock()
+        self.state = STATE_IDLE
+        self.stop_event = threading.Event()
+        self.requests = queue.Queue()
+        # Start a new session once the stopping one ended
+        self.restart = False
+
+    def start(self):
+        with self.lock:
+            if self.state == STATE_STOPPING:
+                if self.restart:
+                    return False
+                self.log.info("A session is stopping, starting another one once it ended.")
+                self.restart = True
+                return True
+            if self.state != STATE_IDLE:
+                self.log.info("A session is already %s, not starting another one.", self.state)
+                return False
+            self.state = STATE_RUNNING
+            self.stop_event.clear()
+        self.requests.put(None)
+        return True
+
+    def stop(self):
+        with self.lock:
+            if self.state == STATE_STOPPING and self.restart:
+                self.log.info("A session is stopping, no longer starting another one.")
+                self.restart = False
+                return True
+            if self.state != STATE_RUNNING:
+                return False
+            self.state = STATE_STOPPING
+            self.stop_event.set()
+        return True
+
+    def is_running(self):
+        with self.lock:
+            return self.state != STATE_IDLE
+
+    def serve_forever(self):
+        """Run the sessions as they are started, until shutdown()."""
+        while True:
+            request = self.requests.get()
+            if request is _SHUTDOWN:
+                break
+
+            self.log.info("Session started.")
+            result = None
+            try:
+                result = self.run_session(self.stop_event)
+            except Exception:
+                self.log.exception("Session failed.")
+            stopped = self.stop_event.is_set()
+            self.log.info("Session %s.", "stopped" if stopped else "finished")
+
+            with self.lock:
+                if self.restart:
+                    # Queued behind this report, so the reports keep their order
+                    self.restart = False
+                    self.state = STATE_RUNNING
+                    self.stop_event.clear()
+                    self.requests.put(None)
+                else:
+                    self.state = STATE_IDLE
+            if result is not None:
+                self.on_finished(result, stopped)
+
+    def shutdown(self):
+        """Stop the running session if any, and let serve_forever() return."""
+        with self.lock:
+            self.restart = False
+        self.stop()
+        self.requests.put(_SHUTDOWN)
+
+# ============================================================================
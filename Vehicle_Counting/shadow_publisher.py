@@ -0,0 +1,183 @@
+# ------------------------------------------
+# --- Author: Bing
+# --- Version: 1.0
+# --- Description: Coalescing, rate-limited publisher of reported shadow state
+# ---              (the same file is in AWS_IoT/ and Vehicle_Counting/, keep them in sync)
+# ------------------------------------------
+import logging
+import json
+import threading
+import time
+
+# ============================================================================
+
+# paho.mqtt return codes, a QoS 1 message published while disconnected is
+# queued by paho and sent after reconnecting
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+# ============================================================================
+
+def merge_state(target, changes):
+    """Merge reported state changes into target, nested objects key by key."""
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_state(target[key], value)
+        elif isinstance(value, dict):
+            # A copy, the caller may change its dict after reporting it
+            target[key] = merge_state({}, value)
+        else:
+            target[key] = value
+    return target
+
+# ============================================================================
+
+class ShadowPublisher(object):
+    """Publishes reported state to a shadow update topic, merging changes that come in bursts.
+
+    report() only merges the changes into the pending state and returns. A
+    thread publishes the pending state as one document, at the earliest
+    `flush_interval` seconds after its first change, at most `max_rate`
+    documents per second, and only while fewer than `max_in_flight` QoS 1
+    documents wait for their PUBACK. Whatever changes meanwhile goes into the
+    next document, so under load fewer documents are sent, each with the
+    latest state.
+
+    It sets the on_publish callback of the client to track the PUBACKs, an
+    on_publish set before is still called.
+
+    With an `outbox` the documents are handed to it instead, which stores and
+    delivers them, and tracks their PUBACKs itself.
+    """
+    def __init__(self, client, topic, flush_interval=0.5, max_rate=1.0, max_in_flight=4, qos=1
+        , outbox=None):
+        self.log = logging.getLogger("shadow_publisher")
+
+        self.client = client
+        self.topic = topic
+        self.flush_interval = flush_interval
+        self.min_gap = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.max_in_flight = max(1, max_in_flight)
+        self.qos = qos
+        self.outbox = outbox
+
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.first_change = None
+        self.last_sent = 0.0
+        self.in_flight = set()
+        # PUBACKs can arrive before publish() returned the message id. Only those that
+        # arrive during a publish() are kept, until it returns, so the PUBACKs of messages
+        # published by others (the shadow GET) never pile up, nor match a later message id
+        self.publishing = False
+        self.acked_early = set()
+        self.closing = False
+
+        self.reports = 0
+        self.sent = 0
+        self.max_in_flight_seen = 0
+
+        self.chained_on_publish = client.on_publish
+        if outbox is None:
+            client.on_publish = self._on_publish
+
+        self.thread = threading.Thread(target=self._run, name="shadow_publisher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def report(self, reported):
+        """Queue changes of the reported state, a dict like {"LED": "ON"}."""
+        with self.cond:
+            merge_state(self.pending, reported)
+            self.reports += 1
+            if self.first_change is None:
+                self.first_change = time.time()
+            self.cond.notify_all()
+
+    def report_document(self, document):
+        """Queue the reported state of a shadow update document (a JSON string)."""
+        self.report(json.loads(document)["state"]["reported"])
+
+    def _on_publish(self, client, userdata, mid):
+        with self.cond:
+            if mid in self.in_flight:
+                self.in_flight.discard(mid)
+            elif self.publishing:
+                self.acked_early.add(mid)
+            self.cond.notify_all()
+        if self.chained_on_publish is not None:
+            self.chained_on_publish(client, userdata, mid)
+
+    def _next_send_time(self):
+        return max(self.first_change + self.flush_interval, self.last_sent + self.min_gap)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.pending and len(self.in_flight) < self.max_in_flight:
+                        delay = 0.0 if self.closing else self._next_send_time() - time.time()
+                        if delay <= 0:
+                            break
+                        self.cond.wait(delay)
+                    elif self.closing and not self.pending:
+                        return
+                    else:
+                        self.cond.wait(1.0)
+
+                state = self.pending
+                document = json.dumps({"state": {"reported": state}})
+                self.pending = {}
+                self.first_change = None
+                self.last_sent = time.time()
+
+            if self.outbox is not None:
+                self.outbox.add(self.topic, document, self.qos)
+                with self.cond:
+                    self.sent += 1
+                continue
+
+            # Never hold the lock while publishing, the network thread takes it for PUBACKs
+            with self.cond:
+                self.publishing = True
+            try:
+                info = self.client.publish(self.topic, document, qos=self.qos)
+            finally:
+                with self.cond:
+                    self.publishing = False
+                    acked_early, self.acked_early = self.acked_early, set()
+            rc, mid = info[0], info[1]
+            if rc not in (MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN):
+                self.log.error("Unable to publish the shadow update (rc=%d), retrying.", rc)
+                with self.cond:
+                    # Changes made since then win over the state that was not sent
+                    self.pending = merge_state(state, self.pending)
+                    if self.first_change is None:
+                        self.first_change = time.time()
+                continue
+
+            with self.cond:
+                self.sent += 1
+                if self.qos > 0 and mid not in acked_early:
+                    self.in_flight.add(mid)
+                self.max_in_flight_seen = max(self.max_in_flight_seen, len(self.in_flight))
+
+    def stats(self):
+        with self.cond:
+            return {"reports": self.reports, "sent": self.sent, "in_flight": len(self.in_flight)
+                , "max_in_flight": self.max_in_flight_seen}
+
+    def close(self, timeout=5.0):
+        """Publish the pending state now, and wait up to `timeout` seconds for the PUBACKs."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.in_flight and time.time() < deadline:
+                self.cond.wait(0.1)
+        self.log.info("%(reports)d state reports sent in %(sent)d messages.", self.stats())
+
+# ============================================================================
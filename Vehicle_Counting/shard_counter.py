@@ -0,0 +1,209 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Count vehicles in a long video file by splitting it into shards
+# ---              and counting every shard on its own core
+# ------------------------------------------
+import logging
+import argparse
+import math
+import multiprocessing
+import time
+
+import cv2
+
+import main as counting
+from vehicle_counter import MAX_UNSEEN_FRAMES, ASSIGNERS
+
+# ============================================================================
+
+CV_CAP_PROP_POS_FRAMES = 1
+CV_CAP_PROP_FPS = 5
+CV_CAP_PROP_FRAME_COUNT = 7
+
+# The default history of the OpenCV MOG models, in frames
+MODEL_HISTORY = 200
+
+# The weight left to the frames in front of the warm-up, in the background model
+MODEL_RESIDUE = 0.001
+
+# ============================================================================
+
+def warmup_frames(learning_rate):
+    """The frames to replay in front of a shard, so it starts as the single process would.
+
+    The background model must have forgotten all but MODEL_RESIDUE of what
+    came before the warm-up, and seen at least MODEL_HISTORY frames. Then
+    the tracker must have dropped the vehicles it only saw as noise of the
+    unsettled model.
+    """
+    settle = int(math.ceil(math.log(MODEL_RESIDUE) / math.log(1.0 - learning_rate))) \
+        if 0 < learning_rate < 1 else 1
+    return max(MODEL_HISTORY, settle) + MAX_UNSEEN_FRAMES
+
+
+# Frames replayed in front of every shard so the background model and the
+# tracker have settled by the time the shard proper starts
+DEFAULT_OVERLAP = warmup_frames(counting.BG_LEARNING_RATE)
+
+# ============================================================================
+
+def plan_shards(frame_count, shard_count, overlap=DEFAULT_OVERLAP):
+    """Split [0, frame_count) into contiguous shards.
+
+    Returns a list of (warmup_start, start, end): frames in
+    [warmup_start, start) are only used to warm up, the shard owns [start, end).
+    """
+    shard_count = max(1, min(shard_count, frame_count))
+    shard_size = frame_count // shard_count
+    shards = []
+    for i in range(shard_count):
+        start = i * shard_size
+        end = frame_count if i == shard_count - 1 else start + shard_size
+        shards.append((max(0, start - overlap), start, end))
+    return shards
+
+# ============================================================================
+
+def seek(cap, video, frame_number):
+    """Move the capture to frame_number, returns the (possibly reopened) capture."""
+    log = logging.getLogger("seek")
+
+    if frame_number == 0:
+        return cap
+
+    cap.set(CV_CAP_PROP_POS_FRAMES, frame_number)
+    if int(cap.get(CV_CAP_PROP_POS_FRAMES)) == frame_number:
+        return cap
+
+    # Some containers can't seek exactly, so step through the frames instead.
+    # grab() without retrieve() keeps the skipped frames cheap.
+    log.debug("Inexact seek in '%s', grabbing %d frames instead...", video, frame_number)
+    cap.release()
+    cap = cv2.VideoCapture(video)
+    for _ in range(frame_number):
+        if not cap.grab():
+            break
+    return cap
+
+# ============================================================================
+
+def init_worker(tracker, record_counts):
+    # Workers never show or annotate anything, and track as the calling process would
+    counting.HEADLESS = True
+    counting.SAVE_TO_FRAME = False
+    counting.TRACKER = tracker
+    counting.RECORD_COUNTS = record_counts
+
+
+def count_shard(task):
+    """Count the vehicles that cross the divider inside one shard.
+
+    The shard is stitched to its neighbours by ownership: a vehicle belongs to
+    the shard in which it crosses the divider. The count is reset when the
+    shard proper starts, so the vehicles that crossed during the warm-up are
+    left to the previous shard, and those tracked from the warm-up but
+    crossing inside the shard are counted by this one only.
+    """
+    log = logging.getLogger("count_shard")
+    video, warmup_start, start, end = task
+    began = time.time()
+
+    cap = seek(cv2.VideoCapture(video), video, warmup_start)
+    bg_subtractor = counting.create_bg_subtractor()
+    context = counting.FrameContext()
+    car_counter = None
+
+    frames = 0
+    for frame_number in range(warmup_start, end):
+        ret, frame = cap.read()
+        if not ret:
+            log.error("Frame capture failed at #%d, stopping shard...", frame_number)
+            break
+
+        if car_counter is None:
+            car_counter = counting.create_vehicle_counter(frame)
+
+        if frame_number == start:
+            # Everything counted so far crossed during the warm-up
+            car_counter.vehicle_count = 0
+            if car_counter.counted_frames is not None:
+                del car_counter.counted_frames[:]
+
+        counting.process_frame(frame_number, frame, bg_subtractor, car_counter, context)
+        if frame_number >= start:
+            frames += 1
+
+    cap.release()
+
+    count = car_counter.vehicle_count if car_counter is not None else 0
+    log.info("Shard [%d, %d) counted %d vehicles in %d frames (%.1fs).", start, end, count
+        , frames, time.time() - began)
+    # The frame numbers of the counted vehicles, when RECORD_COUNTS is set
+    counted_frames = car_counter.counted_frames if car_counter is not None else None
+    return {"start": start, "end": end, "frames": frames, "count": count, "counted_frames": counted_frames}
+
+# ============================================================================
+
+def count_video_sharded(video, shard_count, workers=None, overlap=DEFAULT_OVERLAP):
+    """Count the vehicles of a video file with a pool of worker processes.
+
+    Returns (vehicle_count, during, shard_results), like main().
+    """
+    log = logging.getLogger("count_video_sharded")
+
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        raise IOError("Unable to open video '%s'" % video)
+    frame_count = int(cap.get(CV_CAP_PROP_FRAME_COUNT))
+    fps = cap.get(CV_CAP_PROP_FPS)
+    cap.release()
+
+    shards = plan_shards(frame_count, shard_count, overlap)
+    log.debug("Counting %d frames of '%s' in %d shards (overlap=%d)..."
+        , frame_count, video, len(shards), overlap)
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker
+        , initargs=(counting.TRACKER, counting.RECORD_COUNTS))
+    try:
+        results = pool.map(count_shard
+            , [(video, warmup_start, start, end) for (warmup_start, start, end) in shards])
+    finally:
+        pool.close()
+        pool.join()
+
+    count = sum(result["count"] for result in results)
+    frames = sum(result["frames"] for result in results)
+    during = frames / fps if fps else 0.0
+    return count, during, results
+
+# ============================================================================
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Count vehicles in a video file using every core")
+    ap.add_argument("-v", "--video", required=True, help="The path to the video file")
+    ap.add_argument("-n", "--shards", type=int, help="The number of shards, defaults to the number of workers")
+    ap.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count()
+        , help="The number of worker processes")
+    ap.add_argument("-o", "--overlap", type=int, default=DEFAULT_OVERLAP
+        , help="The number of warm-up frames in front of every shard")
+    ap.add_argument("-t", "--tracker", choices=ASSIGNERS, default=counting.TRACKER
+        , help="How the blobs of a frame are assigned to the tracked vehicles")
+    return ap.parse_args()
+
+# ============================================================================
+
+if __name__ == "__main__":
+    args = parse_args()
+    log = counting.init_logging()
+    counting.TRACKER = args.tracker
+
+    start = time.time()
+    cnt, during, results = count_video_sharded(args.video, args.shards or args.workers
+        , args.workers, args.overlap)
+    fqs = cnt * 1.0 / during if during else 0.0
+
+    for result in results:
+        log.info("Shard [%d, %d): %d vehicles", result["start"], result["end"], result["count"])
+    log.info("Counted %d vehicles in %.1fs of video, frequency %f (wall time %.1fs)"
+        , cnt, during, fqs, time.time() - start)
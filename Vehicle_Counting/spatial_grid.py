@@ -0,0 +1,89 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Uniform grid over the points of a frame, to find the points near a position
+# ---              without looking at all of them
+# ------------------------------------------
+import numpy as np
+
+# ============================================================================
+
+# The 3 x 3 cells around a cell, any point closer than a cell size is in one of them
+NEIGHBOURS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+# Cell coordinates are shifted by this, so the key of a cell is never negative
+_OFFSET = 1 << 20
+
+# ============================================================================
+
+class GridIndex(object):
+    """The points of a frame bucketed into square cells of `cell_size` pixels.
+
+    Built once per frame in one pass over the points. near() then only
+    looks at the cells around a position, so finding the points near every
+    vehicle grows with the number of objects, not with their product.
+    """
+    def __init__(self, points, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        for i, (x, y) in enumerate(points):
+            self.cells.setdefault((int(x // self.cell_size), int(y // self.cell_size)), []).append(i)
+
+    def near(self, position):
+        """The indexes of the points in the cells around position, in ascending order.
+
+        Every point within cell_size of position is among them.
+        """
+        cx = int(position[0] // self.cell_size)
+        cy = int(position[1] // self.cell_size)
+        found = []
+        for dx, dy in NEIGHBOURS:
+            found.extend(self.cells.get((cx + dx, cy + dy), ()))
+        found.sort()
+        return found
+
+# ============================================================================
+
+def _cell_keys(cells):
+    return (cells[:, 0] + _OFFSET) * (2 * _OFFSET) + (cells[:, 1] + _OFFSET)
+
+
+def near_pairs(positions, points, cell_size):
+    """Every (position, point) pair in neighbouring cells, as arrays of row and column indexes.
+
+    The same pairs near() finds for every position, but done with NumPy:
+    the points are sorted by cell once, and the range of each neighbouring
+    cell of every position is looked up by binary search. Every pair closer
+    than cell_size is among them.
+    """
+    if len(positions) == 0 or len(points) == 0:
+        empty = np.zeros(0, np.int64)
+        return empty, empty
+
+    cell_size = float(cell_size)
+    point_keys = _cell_keys(np.floor(points / cell_size).astype(np.int64))
+    order = np.argsort(point_keys, kind = "mergesort")
+    sorted_keys = point_keys[order]
+    position_cells = np.floor(positions / cell_size).astype(np.int64)
+    position_ids = np.arange(len(positions))
+
+    rows = []
+    cols = []
+    for dx, dy in NEIGHBOURS:
+        keys = _cell_keys(position_cells + (dx, dy))
+        first = np.searchsorted(sorted_keys, keys, "left")
+        counts = np.searchsorted(sorted_keys, keys, "right") - first
+        total = counts.sum()
+        if total == 0:
+            continue
+        # Expand the range of every position into one index per point
+        run_starts = np.cumsum(counts) - counts
+        rows.append(np.repeat(position_ids, counts))
+        cols.append(order[np.arange(total) + np.repeat(first - run_starts, counts)])
+
+    if not rows:
+        empty = np.zeros(0, np.int64)
+        return empty, empty
+    return np.concatenate(rows), np.concatenate(cols)
+
+# ============================================================================
@@ -1,6 +1,10 @@
+import sys
+
 import cv2
 import numpy as np
 
+from frame_archive import ArchiveReader
+
 # ============================================================================
 
 INPUT_WIDTH = 160
@@ -13,26 +17,49 @@ TILE_COUNT = OUTPUT_TILE_WIDTH * OUTPUT_TILE_HEIGHT
 
 # ============================================================================
 
-def stitch_images(input_format, output_filename):
+def stitch_images(input_format, output_filename, archive=None):
+    """Tile the first frames into one image.
+
+    With an archive, input_format is the kind of frame to read from it
+    (frame, mask or processed) instead of a file name format.
+    """
     output_shape = (INPUT_HEIGHT * OUTPUT_TILE_HEIGHT
         , INPUT_WIDTH * OUTPUT_TILE_WIDTH
         , 3)
     output = np.zeros(output_shape, np.uint8)
 
     for i in range(TILE_COUNT):
-        img = cv2.imread(input_format % i)
+        if archive is None:
+            img = cv2.imread(input_format % i)
+        else:
+            img = archive.read(input_format, i)
+            if img is None:
+                continue
+            if img.ndim == 2:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            # Archived frames keep the capture size
+            if img.shape[:2] != (INPUT_HEIGHT, INPUT_WIDTH):
+                img = cv2.resize(img, (INPUT_WIDTH, INPUT_HEIGHT))
         cv2.rectangle(img, (0, 0), (INPUT_WIDTH - 1, INPUT_HEIGHT - 1), (0, 0, 255), 1)
         # Draw the frame number
         cv2.putText(img, str(i), (2, 10)
             , cv2.FONT_HERSHEY_PLAIN, 0.7, (255, 255, 255), 1)
         x = i % OUTPUT_TILE_WIDTH * INPUT_WIDTH
-        y = i / OUTPUT_TILE_WIDTH * INPUT_HEIGHT
+        y = i // OUTPUT_TILE_WIDTH * INPUT_HEIGHT
         output[y:y+INPUT_HEIGHT, x:x+INPUT_WIDTH,:] = img
 
     cv2.imwrite(output_filename, output)
 
 # ============================================================================
 
-stitch_images("images/frame_%04d.png", "stitched_frames.png")
-stitch_images("images/mask_%04d.png", "stitched_masks.png")
-stitch_images("images/processed_%04d.png", "stitched_processed.png")
\ No newline at end of file
+# python stitch_images.py [archive directory [session]], the last session by default
+if len(sys.argv) > 1:
+    archive = ArchiveReader(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    stitch_images("frame", "stitched_frames.png", archive)
+    stitch_images("mask", "stitched_masks.png", archive)
+    stitch_images("processed", "stitched_processed.png", archive)
+    archive.close()
+else:
+    stitch_images("images/frame_%04d.png", "stitched_frames.png")
+    stitch_images("images/mask_%04d.png", "stitched_masks.png")
+    stitch_images("images/processed_%04d.png", "stitched_processed.png")
\ No newline at end of file
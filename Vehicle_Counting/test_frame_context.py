@@ -0,0 +1,86 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Check that process_frame allocates next to nothing per frame once warmed up
+# ---              Run with `python -m unittest test_frame_context` from this directory
+# ------------------------------------------
+import os
+import unittest
+
+import cv2
+
+import main
+from vehicle_counter import VehicleCounter
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# ============================================================================
+
+VIDEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "video", "video1.avi")
+
+# Frames processed before the first snapshot, and between the two snapshots
+WARM_UP_FRAMES = 100
+MEASURED_FRAMES = 200
+
+# Bytes that may have grown over the measured frames, outside of the tracker
+MAX_GROWTH = 16 * 1024
+
+# Bytes a measured frame may allocate on top of what was live before it, less than one mask buffer
+MAX_FRAME_PEAK = 32 * 1024
+
+# ============================================================================
+
+@unittest.skipIf(tracemalloc is None, "tracemalloc needs Python 3.4 or later")
+@unittest.skipUnless(os.path.exists(VIDEO), "video/video1.avi is missing")
+class FrameContextTest(unittest.TestCase):
+
+    def test_flat_allocations_per_frame(self):
+        cap = cv2.VideoCapture(VIDEO)
+        bg_subtractor = main.create_bg_subtractor()
+        context = main.FrameContext()
+        car_counter = None
+        frame = None
+        peaks = []
+
+        tracemalloc.start()
+        try:
+            for frame_number in range(WARM_UP_FRAMES + MEASURED_FRAMES):
+                ret, frame, _ = main.read_frame(cap, 1, frame)
+                self.assertTrue(ret, "video/video1.avi ended after %d frames" % frame_number)
+                if car_counter is None:
+                    car_counter = VehicleCounter(frame.shape[:2], frame.shape[0] / 2)
+                if frame_number == WARM_UP_FRAMES:
+                    before = tracemalloc.take_snapshot()
+
+                # The peak catches the buffers allocated and freed within the frame
+                current = tracemalloc.get_traced_memory()[0]
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+                main.process_frame(frame_number, frame, bg_subtractor, car_counter, context)
+                if frame_number >= WARM_UP_FRAMES:
+                    peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+            cap.release()
+
+        # The tracker keeps the positions of its vehicles, that is expected to grow
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)
+            , tracemalloc.Filter(False, "*vehicle_counter.py")]
+        stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+        growth = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+
+        self.assertLess(growth, MAX_GROWTH, "%d bytes more after %d frames, mostly at:\n%s"
+            % (growth, MEASURED_FRAMES, "\n".join(str(stat) for stat in stats[:5])))
+
+        # Without reset_peak (Python < 3.9) the peak is the one of the whole run
+        if hasattr(tracemalloc, "reset_peak"):
+            self.assertLess(max(peaks), MAX_FRAME_PEAK, "A frame allocated %d bytes" % max(peaks))
+
+# ============================================================================
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Check that counting a video in shards gives the same total as a single process
+# ---              Run with `python -m unittest test_shard_counter` from this directory
+# ------------------------------------------
+import os
+import unittest
+
+import main as counting
+import shard_counter
+
+# ============================================================================
+
+VIDEO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "video")
+VIDEOS = ["video1.avi", "video2.avi", "video3.avi"]
+
+SHARDS = 4
+WORKERS = 2
+
+# ============================================================================
+
+class ShardCounterTest(unittest.TestCase):
+
+    def setUp(self):
+        # Nothing on screen or disk, and no cached background, so both runs start equal
+        counting.HEADLESS = True
+        counting.SAVE_TO_FRAME = False
+        counting.BG_CACHE_DIR = None
+
+    def test_sharded_total_matches_single_process(self):
+        for name in VIDEOS:
+            video = os.path.join(VIDEO_DIR, name)
+            if not os.path.exists(video):
+                continue
+            with self.subTest(video = name):
+                single, _ = counting.main(video)
+                sharded, _, results = shard_counter.count_video_sharded(video, SHARDS, WORKERS)
+                self.assertEqual(sharded, single, "%s: %d vehicles in shards %s, %d in a single process"
+                    % (name, sharded, [result["count"] for result in results], single))
+
+# ============================================================================
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# ------------------------------------------
+# --- Author: Zixia Liu, Bingbing Rao, Lan Luo
+# --- Version: 1.0
+# --- Description: Structured tracing for the per-contour and per-vehicle hot paths
+# ------------------------------------------
+import logging
+import json
+import threading
+
+# ============================================================================
+
+class Tracer(object):
+    """Writes compact JSONL records about contours and vehicles to a trace file.
+
+    The hot paths only ever test `TRACER.active` before building a record, so
+    a disabled tracer costs a single attribute lookup per call site. When
+    enabled, only one frame out of every `1 / fraction` is traced.
+
+    Record keys: f=frame, k=kind, then per kind
+      contour  i=contour index, b=[x, y, w, h], ok=1 if big enough to be a vehicle
+      match    id=vehicle id, p=[x, y], v=[distance, angle]
+      unseen   id=vehicle id, n=frames since seen
+    """
+    def __init__(self):
+        self.log = logging.getLogger("tracer")
+        self.lock = threading.Lock()
+
+        self.enabled = False
+        self.active = False
+        self.every = 1
+        self.frame_number = -1
+
+        self.path = None
+        self.file = None
+        self.records = 0
+
+        # Toggles asked for by a signal handler, carried out by the next begin_frame()
+        self.toggle_args = None
+        self.toggle_requests = 0
+        self.toggles_done = 0
+
+    def enable(self, path, fraction=1.0):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.path = path
+            self.file = open(path, "a")
+            self.every = max(1, int(round(1.0 / fraction))) if fraction > 0 else 1
+            self.enabled = True
+        self.log.info("Tracing one frame out of %d into '%s'.", self.every, path)
+
+    def disable(self):
+        with self.lock:
+            self.enabled = False
+            self.active = False
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        self.log.info("Tracing stopped after %d records.", self.records)
+
+    def toggle(self, path, fraction=1.0):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable(path, fraction)
+
+    def request_toggle(self, path, fraction=1.0):
+        """toggle() at the start of the next frame, safe to call from a signal handler.
+
+        The handler runs on the main thread, possibly while the counting on
+        that same thread holds the lock in _write(), so it must neither
+        lock nor touch the file.
+        """
+        self.toggle_args = (path, fraction)
+        self.toggle_requests += 1
+
+    def begin_frame(self, frame_number):
+        """Decide whether this frame is traced, called once per frame."""
+        requests = self.toggle_requests
+        if requests != self.toggles_done:
+            # Two signals since the last frame cancel out
+            toggles, self.toggles_done = requests - self.toggles_done, requests
+            if toggles % 2:
+                self.toggle(*self.toggle_args)
+        self.frame_number = frame_number
+        self.active = self.enabled and (frame_number % self.every == 0)
+
+    def _write(self, record):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(record, separators=(",", ":")))
+            self.file.write("\n")
+            self.records += 1
+
+    def contour(self, i, box, valid):
+        self._write({"f": self.frame_number, "k": "contour", "i": i, "b": list(box)
+            , "ok": 1 if valid else 0})
+
+    def match(self, vehicle_id, position, vector):
+        self._write({"f": self.frame_number, "k": "match", "id": vehicle_id
+            , "p": list(position), "v": [round(vector[0], 2), round(vector[1], 2)]})
+
+    def unseen(self, vehicle_id, frames_since_seen):
+        self._write({"f": self.frame_number, "k": "unseen", "id": vehicle_id
+            , "n": frames_since_seen})
+
+# ============================================================================
+
+# The tracer shared by the counting pipeline
+TRACER = Tracer()
+
+# ============================================================================
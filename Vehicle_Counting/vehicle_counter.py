@@ -9,11 +9,146 @@ import math
 import cv2
 import numpy as np
 
+from tracing import TRACER
+from spatial_grid import GridIndex, near_pairs
+
 # ============================================================================
 
 CAR_COLOURS = [ (0,0,255), (0,106,255), (0,216,255), (0,255,182), (0,255,76)
     , (144,255,0), (255,255,0), (255,148,0), (255,0,178), (220,0,255) ]
 
+# Source frames a vehicle may go unseen before we stop tracking it
+MAX_UNSEEN_FRAMES = 7
+
+# How update_count assigns the detections of a frame to the tracked vehicles
+ASSIGN_FIRST = "first"          # each vehicle in turn takes the first detection within its gate
+ASSIGN_GREEDY = "greedy"        # the closest vehicle / detection pairs within the gate go first
+ASSIGN_OPTIMAL = "hungarian"    # the most pairs within the gate, with the least total distance
+
+ASSIGNERS = (ASSIGN_FIRST, ASSIGN_GREEDY, ASSIGN_OPTIMAL)
+
+# The longest vector is_valid_vector accepts (at 25 degrees), for a frame stride of 1
+MAX_GATE_DISTANCE = 30.0
+
+# With at least this many vehicle / match pairs, only the matches in the grid cells
+# around a vehicle are looked at, see spatial_grid. Below, building the grid costs
+# more than it saves: about 10 x 10 pairs for ASSIGN_FIRST, and 64 x 64 for the
+# others, whose pairs are already compared by NumPy (see bench_tracker.py).
+GRID_MIN_PAIRS = 64
+GRID_MIN_PAIRS_NUMPY = 4096
+
+# ============================================================================
+
+def vectors(a, b):
+    """VehicleCounter.get_vector from the points a to the points b, all at once.
+
+    a and b are arrays of (x, y) in their last dimension, that broadcast
+    against each other. Returns the (distance, angle) arrays.
+    """
+    dx = b[..., 0] - a[..., 0]
+    dy = b[..., 1] - a[..., 1]
+    # 0.0 - dx, not -dx: straight up is 180 degrees as in get_vector, not -180
+    return np.hypot(dx, dy), np.degrees(np.arctan2(0.0 - dx, dy))
+
+
+def valid_vectors(distance, angle, scale=1.0):
+    """VehicleCounter.is_valid_vector of every vector of vectors()."""
+    threshold = np.maximum(10.0, -0.008 * angle**2 + 0.4 * angle + 25.0)
+    return distance <= threshold * scale
+
+
+def assign_greedy(rows, cols, distance):
+    """Pair the rows and columns of the candidate pairs closest first, each at most once."""
+    # Equal distances go in vehicle order, as with ASSIGN_FIRST
+    order = np.lexsort((cols, rows, distance))
+    row_taken = set()
+    col_taken = set()
+    pairs = []
+    for k in order:
+        r, c = rows[k], cols[k]
+        if not (r in row_taken or c in col_taken):
+            row_taken.add(r)
+            col_taken.add(c)
+            pairs.append((r, c))
+    return pairs
+
+
+def _hungarian(cost):
+    """The column of each row with the least total cost, for at most as many rows as columns.
+
+    The shortest augmenting path form of the Hungarian method, one row at a
+    time, with the inner loop over the columns done by NumPy.
+    """
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    owner = np.zeros(m + 1, np.int64)   # the row (from 1) of each column (from 1), 0 for none
+    way = np.zeros(m + 1, np.int64)
+    padded = np.empty(m + 1)
+    padded[0] = np.inf
+    for i in range(1, n + 1):
+        owner[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, bool)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            padded[1:] = cost[i0 - 1] - u[i0] - v[1:]
+            free = ~used
+            better = free & (padded < minv)
+            minv[better] = padded[better]
+            way[better] = j0
+            candidates = np.where(free, minv, np.inf)
+            j1 = int(np.argmin(candidates))
+            delta = candidates[j1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            minv[free] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        # Flip the augmenting path
+        while j0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+
+    columns = np.full(n, -1, np.int64)
+    assigned = np.nonzero(owner[1:])[0]
+    columns[owner[1:][assigned] - 1] = assigned
+    return columns
+
+
+def assign_optimal(rows, cols, distance):
+    """Pair as many rows and columns of the candidate pairs as possible, with the least total distance."""
+    if len(rows) == 0:
+        return []
+
+    # A vehicle with a single candidate, that no other vehicle wants, simply takes it.
+    # With wide gaps between the vehicles that is most of them.
+    alone = (np.bincount(rows)[rows] == 1) & (np.bincount(cols)[cols] == 1)
+    pairs = list(zip(rows[alone], cols[alone]))
+    rows, cols, distance = rows[~alone], cols[~alone], distance[~alone]
+    if len(rows) == 0:
+        return pairs
+
+    row_ids, r = np.unique(rows, return_inverse = True)
+    col_ids, c = np.unique(cols, return_inverse = True)
+    n, m = len(row_ids), len(col_ids)
+
+    # A row may also stay unpaired, for more than all candidate pairs cost together,
+    # so one pair more always wins. A pair that is no candidate costs more than all
+    # rows unpaired.
+    unpaired = 1.0 + distance.sum()
+    cost = np.full((n, m + n), unpaired * (n + 1))
+    cost[r, c] = distance
+    cost[:, m:] = unpaired
+
+    columns = _hungarian(cost)
+    pairs.extend((row_ids[i], col_ids[j]) for i, j in enumerate(columns) if j < m)
+    return pairs
+
 # ============================================================================
 
 class Vehicle(object):
@@ -42,8 +177,11 @@ class Vehicle(object):
 # ============================================================================
 
 class VehicleCounter(object):
-    def __init__(self, shape, divider):
+    def __init__(self, shape, divider, frame_stride=1, assigner=ASSIGN_FIRST):
         self.log = logging.getLogger("vehicle_counter")
+        if assigner not in ASSIGNERS:
+            raise ValueError("Unknown assigner '%s'" % assigner)
+        self.assigner = assigner
 
         self.height, self.width = shape
         self.divider = divider
@@ -51,7 +189,22 @@ class VehicleCounter(object):
         self.vehicles = []
         self.next_vehicle_id = 0
         self.vehicle_count = 0
-        self.max_unseen_frames = 7
+        # The frame number of every vehicle counted, only kept once set to a list
+        self.counted_frames = None
+        self.set_frame_stride(frame_stride)
+
+
+    def set_frame_stride(self, frame_stride):
+        """Tell the tracker how many source frames pass between two updates.
+
+        Vehicles move further between sampled frames, so the distance gate
+        grows with the stride, while a vehicle is dropped after the same
+        amount of video time without a match.
+        """
+        self.frame_stride = max(1.0, float(frame_stride))
+        self.max_unseen_frames = max(1, int(math.ceil(MAX_UNSEEN_FRAMES / self.frame_stride)))
+        # No match further than this can pass the gate, the cell size of the grid
+        self.gate_distance = MAX_GATE_DISTANCE * self.frame_stride
 
 
     @staticmethod
@@ -88,39 +241,108 @@ class VehicleCounter(object):
 
 
     @staticmethod
-    def is_valid_vector(a):
+    def is_valid_vector(a, scale=1.0):
         distance, angle = a
         threshold_distance = max(10.0, -0.008 * angle**2 + 0.4 * angle + 25.0)
-        return (distance <= threshold_distance)
+        return (distance <= threshold_distance * scale)
 
 
-    def update_vehicle(self, vehicle, matches):
-        # Find if any of the matches fits this vehicle
-        for i, match in enumerate(matches):
-            contour, centroid = match
+    def update_vehicle(self, vehicle, matches, candidates=None):
+        # Find if any of the matches fits this vehicle, only the candidates when given
+        if candidates is None:
+            candidates = range(len(matches))
+        for i in candidates:
+            contour, centroid = matches[i]
             vector = self.get_vector(vehicle.last_position, centroid)
-            if self.is_valid_vector(vector):
+            if self.is_valid_vector(vector, self.frame_stride):
                 vehicle.add_position(centroid)
-                self.log.debug("Added match (%d, %d) to vehicle #%d. vector=(%0.2f,%0.2f)"
-                    , centroid[0], centroid[1], vehicle.id, vector[0], vector[1])
+                if TRACER.active:
+                    TRACER.match(vehicle.id, centroid, vector)
                 return i
 
         # No matches fit...
         vehicle.frames_since_seen += 1
-        self.log.debug("No match for vehicle #%d. frames_since_seen=%d"
-            , vehicle.id, vehicle.frames_since_seen)
+        if TRACER.active:
+            TRACER.unseen(vehicle.id, vehicle.frames_since_seen)
 
         return None
 
 
-    def update_count(self, matches, output_image = None):
-        self.log.debug("Updating count using %d matches...", len(matches))
+    def use_grid(self, matches):
+        min_pairs = GRID_MIN_PAIRS if self.assigner == ASSIGN_FIRST else GRID_MIN_PAIRS_NUMPY
+        return len(self.vehicles) * len(matches) >= min_pairs
 
-        # First update all the existing vehicles
+
+    def update_vehicles(self, matches):
+        """update_vehicle for every vehicle in turn, returns the matches left over.
+
+        Matches further away than the gate can never fit, so with a grid over
+        the matches each vehicle only tries those in the cells around it, in
+        the same order as it would try all of them.
+        """
+        index = GridIndex([centroid for (contour, centroid) in matches], self.gate_distance) \
+            if self.use_grid(matches) else None
+
+        taken = [False] * len(matches)
         for vehicle in self.vehicles:
-            i = self.update_vehicle(vehicle, matches)
+            candidates = index.near(vehicle.last_position) if index is not None else range(len(matches))
+            i = self.update_vehicle(vehicle, matches, [j for j in candidates if not taken[j]])
             if i is not None:
-                del matches[i]
+                taken[i] = True
+        return [match for (match, t) in zip(matches, taken) if not t]
+
+
+    def assign_matches(self, matches):
+        """Update all the vehicles at once with the assigner, returns the matches left over.
+
+        The candidate pairs are every vehicle with every match, or with a
+        grid only those in neighbouring cells. Their vectors and the gate of
+        is_valid_vector are computed with NumPy instead of pair by pair.
+        """
+        assigned = [None] * len(self.vehicles)
+        if self.vehicles and matches:
+            positions = np.array([vehicle.last_position for vehicle in self.vehicles], np.float64)
+            centroids = np.array([centroid for (contour, centroid) in matches], np.float64)
+            if self.use_grid(matches):
+                rows, cols = near_pairs(positions, centroids, self.gate_distance)
+            else:
+                rows = np.repeat(np.arange(len(positions)), len(centroids))
+                cols = np.tile(np.arange(len(centroids)), len(positions))
+
+            distance, angle = vectors(positions[rows], centroids[cols])
+            valid = valid_vectors(distance, angle, self.frame_stride)
+            rows, cols, distance = rows[valid], cols[valid], distance[valid]
+            if self.assigner == ASSIGN_GREEDY:
+                pairs = assign_greedy(rows, cols, distance)
+            else:
+                pairs = assign_optimal(rows, cols, distance)
+            for r, c in pairs:
+                assigned[r] = c
+
+        taken = [False] * len(matches)
+        for vehicle, i in zip(self.vehicles, assigned):
+            if i is None:
+                vehicle.frames_since_seen += 1
+                if TRACER.active:
+                    TRACER.unseen(vehicle.id, vehicle.frames_since_seen)
+                continue
+
+            contour, centroid = matches[i]
+            if TRACER.active:
+                TRACER.match(vehicle.id, centroid, self.get_vector(vehicle.last_position, centroid))
+            vehicle.add_position(centroid)
+            taken[i] = True
+        return [match for (match, t) in zip(matches, taken) if not t]
+
+
+    def update_count(self, matches, output_image = None, frame_number = None):
+        self.log.debug("Updating count using %d matches...", len(matches))
+
+        # First update all the existing vehicles
+        if self.assigner == ASSIGN_FIRST:
+            matches = self.update_vehicles(matches)
+        else:
+            matches = self.assign_matches(matches)
 
         # Add new vehicles based on the remaining matches
         for match in matches:
@@ -138,6 +360,8 @@ class VehicleCounter(object):
              if not vehicle.counted:
                 self.vehicle_count += 1
                 vehicle.counted = True
+                if self.counted_frames is not None:
+                    self.counted_frames.append(frame_number)
                 self.log.debug("Counted vehicle #%d (total count=%d)."
                     , vehicle.id, self.vehicle_count)
 